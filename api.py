@@ -1,36 +1,656 @@
-from fastapi import FastAPI
-from pydantic import BaseModel, Field
-from model_logic import convert_raw_to_scores, predict_scenario
-import traceback
-
-app = FastAPI()
-
-class ScenarioInput(BaseModel):
-    Target_Category: str
-    Target_Vulnerability: str
-    Terrain_Type: str
-    Civilian_Presence: str
-    Damage_Assessment: str
-    Time_Sensitivity: str
-    Weaponeering: str
-    Friendly_Fire: str
-    Politically_Sensitive: str
-    Legal_Advice: str
-    Ethical_Concerns: str
-    Collateral_Damage_Potential: str
-    AI_Distinction: str = Field(alias='AI_Distinction (%)')
-    AI_Proportionality: str = Field(alias='AI_Proportionality (%)')
-    AI_Military_Necessity: str
-    Human_Distinction: str = Field(alias='Human_Distinction (%)')
-    Human_Proportionality: str = Field(alias='Human_Proportionality (%)')
-    Human_Military_Necessity: str
+import asyncio
+import contextvars
+import logging
+import os
+import tempfile
+import time
+import zlib
+import numpy as np
+import orjson
+from typing import Annotated, Literal, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.requests import ClientDisconnect
+from pydantic import Field, TypeAdapter, ValidationError, create_model
+from model_logic import (
+    convert_raw_to_scores, predict_rows, encode_raw_batch, predict_batch_async,
+    explain_scenario, explain_batch_async, labels, cache_info, InferenceRejected, InferenceTooLarge,
+    inference_executor_info, shutdown_inference_executor, build_result, prediction_cache, explanation_cache, warm_up
+)
+import metrics
+from metrics import BATCH_SIZE, ERRORS, IN_FLIGHT, REQUEST_LATENCY, REQUESTS, STAGE_LATENCY, timed
+from model_store import registry
+from micro_batcher import MicroBatcher
+from scenario_encoder import encoder
 
-@app.post("/predict")
-def predict(input: ScenarioInput):
+# /predict/stream: records scored per chunk, and the longest accepted NDJSON line
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", "1024"))
+STREAM_MAX_LINE_BYTES = int(os.environ.get("STREAM_MAX_LINE_BYTES", str(1 << 20)))
+# Largest piece of spooled results handed to the server per send
+STREAM_SEND_BYTES = 1 << 16
+
+class FastJSONResponse(Response):
+    # orjson straight from the handler's dicts and NumPy arrays; handlers
+    # return it themselves, which skips FastAPI's jsonable_encoder pass
+    media_type = "application/json"
+
+    def render(self, content):
+        with timed("serialize"):
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+# ---------------------------
+# Request metrics
+# ---------------------------
+# Every route records its latency, in-flight count, response status and
+# error type (see metrics.py and GET /metrics). Handlers find their route and
+# start time in these context variables for the per-stage timings.
+current_route = contextvars.ContextVar("current_route", default="")
+request_started = contextvars.ContextVar("request_started", default=None)
+
+class TimedRoute(APIRoute):
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def timed_handler(request):
+            started = time.perf_counter()
+            current_route.set(route)
+            request_started.set(started)
+            IN_FLIGHT.inc(route)
+            status, error = 500, None
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status, error = e.status_code, f"http_{e.status_code}"
+                raise
+            except RequestValidationError:
+                status, error = 422, "validation"
+                raise
+            except Exception as e:
+                # Unexpected errors are not caught by the handlers: the client
+                # gets a 500 and the server logs the traceback
+                error = type(e).__name__
+                raise
+            finally:
+                IN_FLIGHT.dec(route)
+                REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method)
+                REQUESTS.inc(route, str(status))
+                if error is not None:
+                    ERRORS.inc(route, error)
+
+        return timed_handler
+
+def validated():
+    # Called first thing in a handler: time from the route being entered to
+    # here is reading and validating the request body
+    started = request_started.get()
+    if started is not None:
+        STAGE_LATENCY.observe(time.perf_counter() - started, "validate")
+
+def record_error(e, amount=1):
+    # Errors a handler reports in its response body instead of raising
+    ERRORS.inc(current_route.get(), type(e).__name__ if isinstance(e, Exception) else e, amount=amount)
+
+app = FastAPI(default_response_class=FastJSONResponse)
+app.router.route_class = TimedRoute
+# Concurrent /predict calls are scored together, see micro_batcher.py
+batcher = MicroBatcher(predict_rows)
+
+def scenario_field_name(column):
+    # "AI_Distinction (%)" -> "AI_Distinction"; the raw column name stays the JSON key
+    return column.replace(" (%)", "")
+
+# Generated from mappings_fixed.py: every field is a Literal of its mapping's
+# labels, so pydantic-core rejects an unknown label with a structured 422
+# before any scoring code runs.
+ScenarioInput = create_model(
+    "ScenarioInput",
+    **{
+        scenario_field_name(feature.column): (
+            Literal[tuple(feature.labels)],
+            Field(alias=feature.column) if scenario_field_name(feature.column) != feature.column else ...,
+        )
+        for feature in encoder.features
+    },
+)
+# JSON schema of one scenario (labels as enums), built once
+SCENARIO_SCHEMA = ScenarioInput.model_json_schema()
+# The batch endpoints validate every item on its own, so a bad scenario only
+# fails its own entry; their request body is documented by hand
+SCENARIO_ADAPTER = TypeAdapter(ScenarioInput)
+SCENARIO_BATCH_BODY = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"type": "array", "items": SCENARIO_SCHEMA}},
+}}}
+
+def invalid_scenario(e):
+    # Output fields of an item that failed validation, detail as in a 422
+    return {"error": "Invalid scenario", "detail": orjson.loads(e.json(include_url=False, include_context=False))}
+
+async def scenario_batch(request):
+    # (item count, raw inputs of the valid items, {position: error fields})
+    try:
+        items = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        raise invalid_body(f"Invalid JSON: {e}")
+    if not isinstance(items, list):
+        raise invalid_body("Expected a JSON array of scenarios")
+    raw_inputs, errors = [], {}
+    with timed("validate"):
+        for position, item in enumerate(items):
+            try:
+                raw_inputs.append(SCENARIO_ADAPTER.validate_python(item).model_dump(by_alias=True))
+            except ValidationError as e:
+                errors[position] = invalid_scenario(e)
+    return len(items), raw_inputs, errors
+
+def encode_valid(raw_inputs, errors, n_items):
+    # Score matrix of the validated items; encoding failures join `errors`
+    valid_positions = [position for position in range(n_items) if position not in errors]
+    with timed("encode"):
+        scores, encode_errors = encode_raw_batch(raw_inputs)
+    for valid_position, message in encode_errors.items():
+        errors[valid_positions[valid_position]] = {"error": message}
+    if errors:
+        record_error("invalid_scenario", amount=len(errors))
+    return scores
+
+def resolve_model(model_version):
+    # Pinned registry version (404 if unknown), or the active one
+    try:
+        return registry.get(model_version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model version {model_version!r}")
+
+@app.get("/models")
+def models():
+    return FastJSONResponse({"models": registry.versions()})
+
+def inference_rejected(e):
+    # 413 for a request that can never fit the inference queue, 503 while it is full
+    return HTTPException(status_code=413 if isinstance(e, InferenceTooLarge) else 503, detail=str(e))
+
+@app.get("/schema/scenario")
+def scenario_schema():
+    # Same schema as in /openapi.json, for clients that validate before sending
+    return FastJSONResponse(SCENARIO_SCHEMA)
+
+# ---------------------------
+# Liveness and readiness
+# ---------------------------
+# /healthz answers as soon as the process serves requests. /readyz stays 503
+# until the model, its feature columns and the mappings are loaded and
+# warm_up() has scored WARMUP_PREDICTIONS dataset scenarios. Startup waits
+# for the warm-up (on a worker thread, off the event loop), so the server only
+# accepts connections once it is warm; a failed warm-up leaves /readyz at 503.
+readiness = {"status": "starting", "error": None, "warmup": None}
+
+def run_warm_up():
+    log = logging.getLogger("uvicorn.error")
+    try:
+        # Build (and cache) the OpenAPI document before the first request
+        app.openapi()
+        readiness["warmup"] = warm_up()
+        readiness["status"] = "ready"
+        log.info(
+            f"Warmed up model version {readiness['warmup']['model_version']} with "
+            f"{readiness['warmup']['predictions']} predictions in {readiness['warmup']['seconds'] * 1000:.1f} ms"
+        )
+    except Exception as e:
+        readiness["status"] = "failed"
+        readiness["error"] = str(e)
+        log.error(f"Warm-up failed: {e}")
+
+@app.on_event("startup")
+async def startup():
+    readiness["status"] = "warming_up"
+    await asyncio.get_running_loop().run_in_executor(None, run_warm_up)
+
+@app.get("/healthz")
+def healthz():
+    return FastJSONResponse({"status": "ok"})
+
+@app.get("/readyz")
+def readyz():
+    if readiness["status"] != "ready":
+        return FastJSONResponse({"status": readiness["status"], "error": readiness["error"]}, status_code=503)
     try:
-        numeric_data = convert_raw_to_scores(input.dict(by_alias=True))
-        result = predict_scenario(numeric_data)
-        return {"result": result}
+        loaded = registry.get()
     except Exception as e:
-        traceback.print_exc()
-        return {"error": str(e)}
+        return FastJSONResponse({"status": "failed", "error": str(e)}, status_code=503)
+    return FastJSONResponse({"status": "ready", "model": loaded.info(), "warmup": readiness["warmup"]})
+
+@app.on_event("shutdown")
+def shutdown():
+    shutdown_inference_executor()
+
+def collect_runtime():
+    # Gauges read from the caches, batcher, executor and registry at scrape time
+    caches = {"prediction": prediction_cache.info(), "explanation": explanation_cache.info()}
+    yield "mdmp_cache_hits_total", "counter", "Cache lookups that found an entry", [
+        ({"cache": name}, info["hits"]) for name, info in caches.items()]
+    yield "mdmp_cache_misses_total", "counter", "Cache lookups that missed", [
+        ({"cache": name}, info["misses"]) for name, info in caches.items()]
+    yield "mdmp_cache_hit_ratio", "gauge", "Hits over lookups since start", [
+        ({"cache": name}, info["hits"] / max(info["hits"] + info["misses"], 1)) for name, info in caches.items()]
+    yield "mdmp_cache_entries", "gauge", "Entries held by the cache", [
+        ({"cache": name}, info["size"]) for name, info in caches.items()]
+    yield "mdmp_micro_batch_queued", "gauge", "Requests waiting for the next micro-batch", [({}, len(batcher.pending))]
+    executor = inference_executor_info()
+    if executor["started"]:
+        yield "mdmp_inference_queued", "gauge", "Chunks waiting for an inference process", [({}, executor["queued"])]
+        # One per request turned away, whether the queue was full (503) or the request too large (413)
+        yield "mdmp_inference_rejected_total", "counter", "Requests rejected by the inference pool", [
+            ({}, executor["rejected"] + executor["too_large"])]
+    yield "mdmp_model_info", "gauge", "Loaded model versions (1 for the active one)", [
+        ({"version": model["version"], "sha256": model["sha256"] or ""}, 1 if model["active"] else 0)
+        for model in registry.versions()]
+
+metrics.register_collector(collect_runtime)
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+def stats():
+    return FastJSONResponse({
+        "micro_batching": batcher.stats(),
+        "prediction_cache": cache_info(),
+        "inference_executor": inference_executor_info(),
+    })
+
+@app.post("/predict")
+async def predict(input: ScenarioInput, model_version: Optional[str] = None):
+    validated()
+    loaded = resolve_model(model_version)
+    try:
+        with timed("encode"):
+            numeric_data = convert_raw_to_scores(input.model_dump(by_alias=True))
+        result = await batcher.submit(numeric_data, loaded)
+        return FastJSONResponse({"result": result, "model": loaded.info()})
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+
+@app.post("/predict/batch", openapi_extra=SCENARIO_BATCH_BODY)
+async def predict_many(request: Request, model_version: Optional[str] = None):
+    loaded = resolve_model(model_version)
+    n_items, raw_inputs, errors = await scenario_batch(request)
+    BATCH_SIZE.observe(n_items, "predict_batch")
+    try:
+        scores = encode_valid(raw_inputs, errors, n_items)
+        batch = await predict_batch_async(scores, version=loaded)
+        # Per-class arrays are aligned with the input list (null for failed items)
+        results, probabilities, votes, margins = [], [], [], []
+        scored = 0
+        for position in range(n_items):
+            if position in errors:
+                results.append(errors[position])
+                probabilities.append(None)
+                votes.append(None)
+                margins.append(None)
+                continue
+            results.append({"result": {
+                "prediction_code": int(batch["prediction_code"][scored]),
+                "prediction_label": batch["prediction_label"][scored],
+            }})
+            probabilities.append(batch["probabilities"][scored].tolist())
+            votes.append(batch["votes"][scored].tolist())
+            margins.append(float(batch["margin"][scored]))
+            scored += 1
+        return FastJSONResponse({
+            "results": results,
+            "model": loaded.info(),
+            "classes": [labels[code] for code in loaded.forest.classes],
+            "probabilities": probabilities,
+            "votes": votes,
+            "margin": margins,
+        })
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+
+@app.post("/explain")
+def explain(input: ScenarioInput, model_version: Optional[str] = None):
+    validated()
+    loaded = resolve_model(model_version)
+    try:
+        with timed("encode"):
+            numeric_data = convert_raw_to_scores(input.model_dump(by_alias=True))
+        result = explain_scenario(numeric_data, version=loaded)
+        return FastJSONResponse({"result": result, "model": loaded.info()})
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+
+@app.post("/explain/batch", openapi_extra=SCENARIO_BATCH_BODY)
+async def explain_many(request: Request, model_version: Optional[str] = None):
+    loaded = resolve_model(model_version)
+    n_items, raw_inputs, errors = await scenario_batch(request)
+    BATCH_SIZE.observe(n_items, "explain_batch")
+    try:
+        scores = encode_valid(raw_inputs, errors, n_items)
+        batch = await explain_batch_async(scores, version=loaded)
+        # contributions[i] is a features x classes matrix (null for failed items)
+        contributions = []
+        scored = 0
+        for position in range(n_items):
+            if position in errors:
+                contributions.append(None)
+                continue
+            contributions.append(batch["contributions"][scored].tolist())
+            scored += 1
+        return FastJSONResponse({
+            "errors": {str(position): error for position, error in errors.items()},
+            "model": loaded.info(),
+            "classes": [labels[code] for code in loaded.forest.classes],
+            "features": batch["feature_columns"],
+            "bias": batch["bias"].tolist(),
+            "contributions": contributions,
+        })
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+
+# ---------------------------
+# Streaming NDJSON scoring
+# ---------------------------
+# POST /predict/stream takes one ScenarioInput JSON object per line and
+# answers one line per input, in order: {"index": n, "result": {...}} or
+# {"index": n, "error": "..."}. The body is read, scored and answered
+# STREAM_CHUNK_ROWS records at a time, so memory stays bounded whatever the
+# upload size (results waiting for a slow reader go to disk, see ResultSpool).
+# "Content-Encoding: gzip" bodies are inflated on the fly and
+# responses are gzipped when the client accepts it.
+def inflate(decoder, data):
+    # Decompress in bounded pieces so a small, highly compressed chunk can't balloon
+    while data:
+        yield decoder.decompress(data, STREAM_MAX_LINE_BYTES)
+        data = decoder.unconsumed_tail
+
+async def ndjson_lines(request):
+    gzipped = "gzip" in request.headers.get("content-encoding", "")
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    pending = b""
+    async for chunk in request.stream():
+        for data in (inflate(decoder, chunk) if gzipped else [chunk]):
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > STREAM_MAX_LINE_BYTES:
+                raise ValueError(f"NDJSON line longer than {STREAM_MAX_LINE_BYTES} bytes")
+            for line in lines:
+                if line.strip():
+                    yield line
+    if gzipped:
+        if not decoder.eof:
+            raise ValueError("Truncated gzip request body")
+        pending += decoder.flush()
+    if pending.strip():
+        yield pending
+
+async def score_ndjson_chunk(lines, first_index, loaded):
+    # position -> error fields of its output line; validation errors carry the
+    # same structured detail as a 422
+    BATCH_SIZE.observe(len(lines), "stream_chunk")
+    raw_inputs, errors = [], {}
+    with timed("validate"):
+        for position, line in enumerate(lines):
+            try:
+                raw_inputs.append(ScenarioInput.model_validate_json(line).model_dump(by_alias=True))
+            except ValidationError as e:
+                errors[position] = invalid_scenario(e)
+    scores = encode_valid(raw_inputs, errors, len(lines))
+    batch = await predict_batch_async(scores, version=loaded)
+    out = []
+    scored = 0
+    for position in range(len(lines)):
+        record = {"index": first_index + position}
+        if position in errors:
+            record.update(errors[position])
+        else:
+            record["result"] = build_result(
+                loaded,
+                int(batch["prediction_code"][scored]),
+                batch["probabilities"][scored].tolist(),
+                batch["votes"][scored].tolist(),
+            )
+            scored += 1
+        out.append(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY))
+    return b"\n".join(out) + b"\n"
+
+async def score_ndjson_stream(request, loaded):
+    index = 0
+    lines = []
+    try:
+        async for line in ndjson_lines(request):
+            lines.append(line)
+            if len(lines) >= STREAM_CHUNK_ROWS:
+                yield await score_ndjson_chunk(lines, index, loaded)
+                index += len(lines)
+                lines = []
+        if lines:
+            yield await score_ndjson_chunk(lines, index, loaded)
+    except ClientDisconnect:
+        return
+    except (ValueError, zlib.error, InferenceRejected) as e:
+        # Headers are already sent; the last line reports why the stream stopped
+        record_error(e)
+        yield orjson.dumps({"index": index, "error": str(e), "fatal": True}) + b"\n"
+
+class BodyStreamingResponse(StreamingResponse):
+    # Streams a response while the handler is still reading the request body.
+    # StreamingResponse would also listen for disconnects on servers speaking
+    # ASGI < 2.4 (uvicorn does), and that listener swallows body messages; the
+    # body reader notices a disconnect on its own.
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+class ResultSpool:
+    # Scored chunks are appended to an unlinked temp file and sent from there.
+    # Clients like httpx or requests upload the whole body before they read
+    # any of the response; without the spool the unread results would fill the
+    # socket buffers, the server would stop reading the body and both sides
+    # would wait forever. The file is emptied whenever the sender catches up.
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.written = 0
+        self.sent = 0
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def write(self, data):
+        os.pwrite(self.file.fileno(), data, self.written)
+        self.written += len(data)
+        self.changed.set()
+
+    def read(self):
+        data = os.pread(self.file.fileno(), min(self.written - self.sent, STREAM_SEND_BYTES), self.sent)
+        self.sent += len(data)
+        if self.sent == self.written:
+            self.file.truncate(0)
+            self.sent = self.written = 0
+        return data
+
+async def spooled(chunks):
+    # Runs `chunks` in its own task, so the request body keeps being read and
+    # scored however slowly the response is consumed
+    spool = ResultSpool()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                spool.write(chunk)
+        except Exception as e:
+            spool.error = e
+        finally:
+            spool.done = True
+            spool.changed.set()
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if spool.sent < spool.written:
+                yield spool.read()
+            elif spool.done:
+                if spool.error is not None:
+                    raise spool.error
+                return
+            else:
+                spool.changed.clear()
+                await spool.changed.wait()
+    finally:
+        producer.cancel()
+        spool.file.close()
+
+async def gzip_stream(chunks):
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        # Sync flush so every scored chunk reaches the client right away
+        yield encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)
+    yield encoder.flush()
+
+@app.post("/predict/stream")
+async def predict_stream(request: Request, model_version: Optional[str] = None):
+    loaded = resolve_model(model_version)
+    body = spooled(score_ndjson_stream(request, loaded))
+    headers = {"X-Model-Version": loaded.version}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    return BodyStreamingResponse(body, media_type="application/x-ndjson", headers=headers)
+
+# ---------------------------
+# Integer-coded requests
+# ---------------------------
+# A scenario can also be sent as one integer code per feature, in
+# trained_feature_columns order (without Total_Score); a label's code is its
+# position in the mapping, see GET /schema/codes. POST /predict/codes takes
+# {"codes": [...]} for one scenario. POST /predict/batch/codes takes a matrix
+# of codes as
+#   application/json                     {"codes": [[...], ...]}
+#   application/octet-stream             raw little-endian codes, row-major
+#                                        (n_rows, n_features), ?dtype=int8|int16|int32
+#   application/vnd.apache.arrow.stream  Arrow IPC stream, one integer column
+#                                        per feature (by name, else by position)
+# Binary bodies are read as NumPy views of the request bytes, one code column
+# per feature, and scored without building per-row objects. The batch
+# response holds one array per output (null-free, same row order).
+RAW_CODE_DTYPES = {"int8": "<i1", "int16": "<i2", "int32": "<i4"}
+ARROW_MEDIA_TYPES = ("application/vnd.apache.arrow.stream", "application/vnd.apache.arrow.file")
+
+ScenarioCodes = create_model(
+    "ScenarioCodes",
+    codes=(Tuple[tuple(Annotated[int, Field(ge=0, lt=len(feature.labels))] for feature in encoder.features)], ...),
+)
+CODES_SCHEMA = {
+    "columns": encoder.columns,
+    "labels": {feature.column: feature.labels for feature in encoder.features},
+}
+
+def invalid_body(message, loc=("body",), value=None):
+    return HTTPException(status_code=422, detail=[{"type": "value_error", "loc": list(loc), "msg": message, "input": value}])
+
+def code_columns_from_json(body):
+    try:
+        codes = np.asarray(orjson.loads(body)["codes"])
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise invalid_body(f'Expected {{"codes": [[...], ...]}}: {e}')
+    if not codes.size:
+        codes = np.empty((0, len(encoder.features)), dtype=np.int16)
+    if codes.ndim != 2 or codes.shape[1] != len(encoder.features) or not np.issubdtype(codes.dtype, np.integer):
+        raise invalid_body(f"codes must be a list of rows of {len(encoder.features)} integers", ("body", "codes"))
+    return [codes[:, index] for index in range(len(encoder.features))]
+
+def code_columns_from_raw(body, dtype):
+    if dtype not in RAW_CODE_DTYPES:
+        raise invalid_body(f"dtype must be one of {sorted(RAW_CODE_DTYPES)}", ("query", "dtype"), dtype)
+    itemsize = np.dtype(RAW_CODE_DTYPES[dtype]).itemsize
+    if len(body) % (itemsize * len(encoder.features)):
+        raise invalid_body(f"Body is not a whole number of {len(encoder.features)}-code {dtype} rows")
+    codes = np.frombuffer(body, dtype=RAW_CODE_DTYPES[dtype]).reshape(-1, len(encoder.features))
+    return [codes[:, index] for index in range(len(encoder.features))]
+
+def code_columns_from_arrow(body):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(status_code=415, detail="Arrow request bodies need pyarrow on the server")
+    try:
+        table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    except pa.ArrowInvalid:
+        try:
+            table = pa.ipc.open_file(pa.py_buffer(body)).read_all()
+        except pa.ArrowInvalid as e:
+            raise invalid_body(f"Not an Arrow IPC stream or file: {e}")
+    by_name = all(column in table.column_names for column in encoder.columns)
+    if not by_name and table.num_columns != len(encoder.features):
+        raise invalid_body(f"Expected the columns {encoder.columns} or {len(encoder.features)} integer columns")
+    columns = []
+    for index, column_name in enumerate(encoder.columns):
+        column = table.column(column_name if by_name else index)
+        if not pa.types.is_integer(column.type) or column.null_count:
+            raise invalid_body(f"Column {column_name} must be integers without nulls", ("body", column_name))
+        # A single chunk is viewed in place; several are concatenated once
+        chunk = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        columns.append(chunk.to_numpy(zero_copy_only=True))
+    return columns
+
+@app.get("/schema/codes")
+def codes_schema():
+    # Feature order and the label behind every code
+    return FastJSONResponse(CODES_SCHEMA)
+
+@app.post("/predict/codes")
+async def predict_codes(input: ScenarioCodes, model_version: Optional[str] = None):
+    validated()
+    loaded = resolve_model(model_version)
+    try:
+        numeric_data = dict(zip(encoder.score_columns, encoder.scores_from_codes(input.codes).tolist()))
+        result = await batcher.submit(numeric_data, loaded)
+        return FastJSONResponse({"result": result, "model": loaded.info()})
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+
+@app.post("/predict/batch/codes", openapi_extra={"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"type": "object", "properties": {"codes": {"type": "array", "items": {
+        "type": "array", "items": {"type": "integer"}}}}}},
+    "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+    ARROW_MEDIA_TYPES[0]: {"schema": {"type": "string", "format": "binary"}},
+}}})
+async def predict_codes_batch(request: Request, model_version: Optional[str] = None, dtype: str = "int16"):
+    loaded = resolve_model(model_version)
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+    body = await request.body()
+    with timed("decode"):
+        if content_type in ARROW_MEDIA_TYPES:
+            columns = code_columns_from_arrow(body)
+        elif content_type == "application/octet-stream":
+            columns = code_columns_from_raw(body, dtype)
+        elif content_type == "application/json":
+            columns = code_columns_from_json(body)
+        else:
+            raise HTTPException(status_code=415, detail=f"Unsupported content type {content_type!r}")
+    BATCH_SIZE.observe(len(columns[0]), "codes_batch")
+    invalid = encoder.invalid_codes(columns)
+    if invalid:
+        raise HTTPException(status_code=422, detail=[
+            {"type": "value_error", "loc": ["body", row, encoder.columns[index]],
+             "msg": f"Code should be between 0 and {len(encoder.features[index].labels) - 1}", "input": code}
+            for row, index, code in invalid
+        ])
+    with timed("encode"):
+        scores = encoder.scores_from_code_columns(columns)
+    try:
+        batch = await predict_batch_async(scores, version=loaded)
+    except InferenceRejected as e:
+        raise inference_rejected(e)
+    return FastJSONResponse({
+        "model": loaded.info(),
+        "classes": [labels[code] for code in loaded.forest.classes],
+        "prediction_code": batch["prediction_code"],
+        "prediction_label": batch["prediction_label"],
+        "probabilities": batch["probabilities"],
+        "votes": batch["votes"],
+        "margin": batch["margin"],
+    })
@@ -27,8 +27,6 @@ import logging
 import time
 import pandas as pd
 import joblib
-from google.oauth2.service_account import Credentials
-import gspread
 from io import BytesIO
 from docx import Document
 from docx.shared import RGBColor
@@ -44,6 +42,7 @@ from mappings_fixed import (
 from app_main import (
     calculate_percentages,
     assign_final_decision,
+    open_study_sheet,
 )
 
 # --- Google Sheets Functions ---
@@ -53,17 +52,12 @@ def get_google_sheet():
         creds_dict = dict(st.secrets["gcp_service_account"])
         # Replace any escaped newline characters with actual newlines
         creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-        creds = Credentials.from_service_account_info(
-            creds_dict,
-            scopes=[
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive.file",
-                "https://www.googleapis.com/auth/drive"
-            ]
-        )
-        client = gspread.authorize(creds)
-        return client.open("Study_data").sheet1
+        return open_study_sheet(tuple(sorted(creds_dict.items())), scopes=(
+            "https://spreadsheets.google.com/feeds",
+            "https://www.googleapis.com/auth/spreadsheets",
+            "https://www.googleapis.com/auth/drive.file",
+            "https://www.googleapis.com/auth/drive",
+        ))
     except Exception as e:
         st.error(f"Error connecting to Google Sheets: {e}")
         return None
@@ -1,12 +1,18 @@
 import streamlit as st
 import pandas as pd
-import joblib
-import random
 import os
 import logging
+import math
 import time
 import gspread
 from google.oauth2.service_account import Credentials
+from model_store import get_scenario_sampler
+from model_logic import explain_scenario, features_from_mapping, get_model, predict_features
+from override_rules import assign_final_decision
+from civilian_presence import civilian_presence_interval
+from study_flow import (
+    DECISION_SECONDS, SCENARIO_FLOWS, SCENARIO_RESET, TIMER_RESET, TOTAL_SCENARIOS, apply_reset, transition
+)
 
 
 # ---------------------------
@@ -28,13 +34,14 @@ session_vars = [
     "progress", "start_time", "decision_time",
     "submitted_decision", "submitted_feedback",
     "scenario_generated", "model_generated", "revealed_reasoning",
-    "raw_model_prediction", "scenario_count", "flow", "new_step_index"
+    "raw_model_prediction", "scenario_count", "flow",
+    "decision_deadline", "timeout_handled", "study_completed"
 ]
 for var in session_vars:
     if var not in st.session_state:
         if var == "step":
             st.session_state[var] = 1
-        elif var in ["scenario_generated", "model_generated", "revealed_reasoning"]:
+        elif var in ["scenario_generated", "model_generated", "revealed_reasoning", "timeout_handled", "study_completed"]:
             st.session_state[var] = False
         else:
             st.session_state[var] = None
@@ -42,16 +49,11 @@ for var in session_vars:
 if st.session_state.scenario_count is None:
     st.session_state.scenario_count = 1  # Start with scenario 1
 if st.session_state.flow is None:
-    # Use "original" flow for scenarios 1–5; "reordered" for scenarios 6–10
-    if st.session_state.scenario_count <= 5:
-        st.session_state.flow = "original"
-    else:
-        st.session_state.flow = "reordered"
-if st.session_state.new_step_index is None:
-    st.session_state.new_step_index = 0
+    # "original" flow for scenarios 1–5, "reordered" for 6–10 (see study_flow.py)
+    st.session_state.flow = SCENARIO_FLOWS[st.session_state.scenario_count]
 
 if "time_remaining" not in st.session_state:
-    st.session_state.time_remaining = 300
+    st.session_state.time_remaining = DECISION_SECONDS
 if "timer_active" not in st.session_state:
     st.session_state.timer_active = False
 if "start" not in st.session_state or st.session_state.start is None:
@@ -83,12 +85,14 @@ def get_markdown_text(text, style_key):
     return f"{style}>{text}</{tag}>"
 
 def convert_civilian_presence(value):
-    if isinstance(value, str) and '-' in value:
-        return value
-    try:
-        return str(int(value))
-    except ValueError:
+    # Civilian_Presence label as written ("1-10", ">100", "100+") without the
+    # dataset's stray spaces; numbers as integers, "0" when it is no head count
+    interval = civilian_presence_interval(value)
+    if interval is None:
         return "0"
+    if isinstance(value, str):
+        return value.strip()
+    return str(interval[0])
 
 # ---------------------------
 # Data Columns & Model Files
@@ -121,36 +125,11 @@ label_mapping = {
     3: 'Engage'
 }
 
-try:
-    model_path = 'MDMP_model.joblib'
-    features_path = 'MDMP_feature_columns.joblib'
-    csv_path = 'dataset_with_all_category_scores.csv'
-    
-    rf_model_loaded = joblib.load(model_path)
-    trained_feature_columns = joblib.load(features_path)
-    df = pd.read_csv(csv_path)
-    print("Loaded data columns:", df.columns.tolist())
-    print("Trained feature columns:", trained_feature_columns)
-    logging.info("Model and data loaded successfully.")
-except Exception as e:
-    st.error(f"Error loading model or data: {e}")
-    logging.error(f"Error loading model or data: {e}")
-    st.stop()
-
-def shuffle_dataset(df):
-    print("Original columns:", df.columns.tolist())
-    df_shuffled = df.copy()
-    for related_columns in columns_to_shuffle:
-        print(f"Processing columns: {related_columns}")
-        shuffled_subset = df[related_columns].sample(frac=1, random_state=random.randint(0, 10000)).reset_index(drop=True)
-        df_shuffled[related_columns] = shuffled_subset
-    df_shuffled['Total_Score'] = df_shuffled[score_columns].sum(axis=1)
-    print("Final columns:", df_shuffled.columns.tolist())
-    return df_shuffled
-
-def get_random_scenario(df):
-    random_index = random.randint(0, len(df) - 1)
-    return df.iloc[random_index]
+# The model, feature columns, dataset and scenario sampler are loaded on first
+# use by model_store and shared by every session and rerun in this process;
+# each is reloaded when its file changes on disk. (This script runs as a fresh
+# module on every rerun, so nothing cached here would survive.) The Google
+# Sheets client is a Streamlit resource, see open_study_sheet().
 
 def calculate_percentages(scores):
     total_abs = sum(abs(v) for k, v in scores.items() if k != "Total_Score")
@@ -172,16 +151,6 @@ def get_score_display(score, percentage):
         color = "#6c757d"
     return f"<b>{score}</b> (<span style='color:{color}'>{percentage:.2f}%</span>)"
 
-def assign_final_decision(total_score):
-    if total_score >= 30:
-        return 'Engage'
-    elif total_score >= 22.5:
-        return 'Ask Authorization'
-    elif total_score >= 15:
-        return 'Do Not Know'
-    else:
-        return 'Do Not Engage'
-
 def verify_scenario_data(scenario):
     required_columns = [col[0] for col in columns_to_shuffle]
     if isinstance(scenario, pd.Series) or any(col in scenario.index for col in required_columns):
@@ -191,85 +160,40 @@ def verify_scenario_data(scenario):
         return missing_columns
     return []
 
-def get_final_prediction(scenario_df, model):
+def get_final_prediction(scenario, version=None):
+    # scenario: the dataset row shown to the participant (labels and *_Score columns).
+    # The model only sees its trained feature columns. The study UI has never
+    # applied override rules: the decision comes from the total score.
     try:
-        if 'Total_Score' not in scenario_df.columns or pd.isna(scenario_df['Total_Score']).all():
-            scenario_df['Total_Score'] = scenario_df[score_columns].sum(axis=1)
-        total_score = scenario_df['Total_Score'].iloc[0]
-        override_decision, override_reason = apply_override_rules(scenario_df.iloc[0])
+        features = scenario[get_model(version).feature_columns].copy()
+        if pd.isna(features['Total_Score']):
+            features['Total_Score'] = features[score_columns].sum()
+        total_score = features['Total_Score']
         try:
-            model_pred = model.predict(scenario_df)[0]
-            model_label = label_mapping.get(model_pred, "Unknown")
+            model_pred = predict_features(features_from_mapping(features, version), version)["prediction_code"][0]
+            model_label = label_mapping.get(int(model_pred), "Unknown")
         except Exception as e:
             logging.error(f"Error in model prediction: {e}")
             model_label = None
-        if override_decision:
-            return override_decision, f"OVERRIDE APPLIED: {override_reason}", model_label
-        else:
-            score_based_decision = assign_final_decision(total_score)
-            return score_based_decision, "", model_label
+        return assign_final_decision(total_score), "", model_label
     except Exception as e:
         logging.error(f"Error in get_final_prediction: {e}")
         return None, f"Error in prediction: {e}", None
 
 
 
-def apply_override_rules(row):
-    try:
-        categories = {col: row[col] for col in row.index if not col.endswith('_Score')}
-        if 'Total_Score' not in row or pd.isna(row['Total_Score']):
-            row['Total_Score'] = row[[col for col in row.index if col.endswith('_Score')]].sum()
-            logging.info("Calculated Total_Score in apply_override_rules")
-        if categories['Target_Category'] in ["Chapel", "Medical Installation", "Medical Vehicle"]:
-            return "Do Not Engage", f"Protected Target_Category '{categories['Target_Category']}'"
-        if (categories['Terrain_Type'] in ["Urban Center", "Residential Area"]) and \
-           (categories['Target_Category'] not in ["High-Value Target", "Battalion HQ", "Battlegroup HQ", "Brigade HQ", "Division HQ"]):
-            return "Do Not Engage", f"Non-priority target in {categories['Terrain_Type']}"
-        if categories['Ethical_Concerns'] == 'Immoral' and row['Total_Score'] >= 30:
-            return "Do Not Engage", "Ethical concerns override high score"
-        try:
-            civilian_presence = categories['Civilian_Presence']
-            if isinstance(civilian_presence, str) and '-' in civilian_presence:
-                civilian_presence = int(civilian_presence.split('-')[0])
-            else:
-                civilian_presence = int(civilian_presence)
-            if civilian_presence >= 100:
-                return "Do Not Engage", f"High civilian presence: {categories['Civilian_Presence']}"
-        except (ValueError, TypeError):
-            logging.warning(f"Could not parse Civilian_Presence value: {categories['Civilian_Presence']}")
-        if categories['Collateral_Damage_Potential'] == 'Very_High' and \
-           any(str(categories['Civilian_Presence']).startswith(x) for x in ['50', '100']):
-            return "Do Not Engage", "High collateral damage risk with significant civilian presence"
-        if categories['Friendly_Fire'] == "Very_High" and categories['Collateral_Damage_Potential'] == 'Very_High':
-            return "Do Not Engage", "Multiple high-risk factors present"
-        try:
-            cp_value = categories['Civilian_Presence']
-            if isinstance(cp_value, str) and '-' in cp_value:
-                cp_value = int(cp_value.split('-')[0])
-            else:
-                cp_value = int(cp_value)
-            if cp_value > 30 and categories['Weaponeering'] in ["Incendiary Weapon", "Thermobaric Munition", "White Phosphorus Bomb"]:
-                return "Ask Authorization", "Special weapons with civilian presence > 30"
-        except (ValueError, TypeError):
-            logging.warning(f"Could not parse Civilian_Presence value for special weapons check")
-        if categories['Legal_Advice'] in ['It depends', 'Questionable'] or \
-           (categories['Ethical_Concerns'] == 'Immoral' and cp_value > 50):
-            return "Ask Authorization", "Legal/ethical concerns require authorization"
-        if categories['Politically_Sensitive'] == "High" and categories['Terrain_Type'] == "Critical Infrastructure Area":
-            return "Ask Authorization", "Sensitive infrastructure engagement"
-        if categories['Weaponeering'] == "Anti-Personnel Mine" and \
-           categories['Target_Category'] in ["Fighter Aircraft", "Frigate", "Ship Maintenance Facility", "Naval Base"]:
-            return "Do Not Know", "Inappropriate weapon for target type"
-        if categories['Weaponeering'] == "Torpedo" and \
-           categories['Target_Category'] not in ["Ship Maintenance Facility", "Naval Base", "Frigate"]:
-            return "Do Not Know", "Torpedo inappropriate for non-naval target"
-        return None, "No override rules applied"
-    except KeyError as e:
-        logging.error(f"Missing required column in override rules: {e}")
-        return None, "No override rules applied"
-    except Exception as e:
-        logging.error(f"Unexpected error in apply_override_rules: {e}")
-        return None, "No override rules applied"
+SHEETS_SCOPES = (
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+)
+
+@st.cache_resource(show_spinner=False)
+def open_study_sheet(credentials, scopes=SHEETS_SCOPES):
+    # One authorized client per process and set of credentials (a sorted tuple
+    # of the service account fields), so rotated secrets get a new client.
+    # Failures raise and are not cached.
+    creds = Credentials.from_service_account_info(dict(credentials), scopes=list(scopes))
+    return gspread.authorize(creds).open("Study_data").sheet1
 
 def get_google_sheet():
     try:
@@ -277,15 +201,7 @@ def get_google_sheet():
         creds_dict = dict(st.secrets["gcp_service_account"])
         # Replace escaped newlines with actual newlines in the private key
         creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-        creds = Credentials.from_service_account_info(
-            creds_dict,
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive"
-            ]
-        )
-        client = gspread.authorize(creds)
-        return client.open("Study_data").sheet1
+        return open_study_sheet(tuple(sorted(creds_dict.items())))
     except Exception as e:
         st.error(f"Error connecting to Google Sheets: {e}")
         return None
@@ -309,11 +225,24 @@ def save_data_to_google_sheet(data):
             st.error(f"Error saving data to Google Sheets: {e}")
             logging.error(f"Error saving data to Google Sheets: {e}")
 
-def display_scenario_with_scores(scenario, feature_importances=None, override_reason=None):
+def get_contribution_display(contribution):
+    # Contribution to the predicted class probability, in percentage points
+    points = contribution * 100
+    if points > 0:
+        color = "#28a745"
+    elif points < 0:
+        color = "#dc3545"
+    else:
+        color = "#6c757d"
+    return f"<span style='color:{color}'>model {points:+.1f} pts</span>"
+
+def display_scenario_with_scores(scenario, explanation=None, override_reason=None):
     columns_to_display = [col[0] for col in columns_to_shuffle]
     if st.session_state.step < 6:
         for column in columns_to_display:
             value = scenario[column] if column in scenario and pd.notna(scenario[column]) else "Unknown"
+            if column == 'Civilian_Presence' and value != "Unknown":
+                value = convert_civilian_presence(value)
             st.markdown(f"""
                 <div style='font-size: 16px; margin-bottom: 1px;'>
                     <b>{column}</b>: {value}
@@ -322,96 +251,113 @@ def display_scenario_with_scores(scenario, feature_importances=None, override_re
     else:
         scores = {f"{col}_Score": scenario[f"{col}_Score"] for col in columns_to_display if f"{col}_Score" in scenario}
         percentages = calculate_percentages(scores)
+        # explanation (from explain_scenario) adds each score's contribution to the model's predicted class
+        contributions = {}
+        if explanation:
+            explained_label = explanation["prediction_label"]
+            contributions = {col: values[explained_label] for col, values in explanation["contributions"].items()}
+            st.markdown(f"""
+                <div style='font-size: 18px; margin-bottom: 10px;'>
+                    Model base rate for <b>{explained_label}</b>: {explanation["bias"][explained_label] * 100:.1f}%,
+                    predicted probability: {explanation["probabilities"][explained_label] * 100:.1f}%
+                </div>
+            """, unsafe_allow_html=True)
         for score_col, score_val in scores.items():
             pct = percentages.get(score_col, 0)
             parameter = score_col.replace('_Score', '')
             score_display = get_score_display(score_val, pct)
+            contribution_display = get_contribution_display(contributions[score_col]) if score_col in contributions else ""
             st.markdown(f"""
                 <div style='display: flex; justify-content: flex-start; align-items: center; margin-bottom: 2px;'>
                     <span style='font-weight: bold; margin-right: 5px; font-size: 20px;'>{parameter}:</span>
-                    <span style='margin-right: 5px; font-size: 20px;'>{scenario[parameter]}</span>
-                    <span style='font-size: 20px;'><b>{score_val}</b> ({pct:.2f}%)</span>
+                    <span style='margin-right: 5px; font-size: 20px;'>{convert_civilian_presence(scenario[parameter]) if parameter == 'Civilian_Presence' else scenario[parameter]}</span>
+                    <span style='margin-right: 5px; font-size: 20px;'><b>{score_val}</b> ({pct:.2f}%)</span>
+                    <span style='font-size: 20px;'>{contribution_display}</span>
                 </div>
                 <div class='dotted-line'></div>
             """, unsafe_allow_html=True)
         total_score = sum(scores.values())
+        total_contribution = get_contribution_display(contributions["Total_Score"]) if "Total_Score" in contributions else ""
         st.markdown(f"""
             <div style='margin-top: 15px; color: #CC0000; font-weight: bold;'>
-                Total Score: {total_score}
+                Total Score: {total_score} {total_contribution}
             </div>
         """, unsafe_allow_html=True)
 
 # ---------------------------
-# Navigation Functions (with updated multi-scenario logic)
+# Navigation Functions
 # ---------------------------
+# Steps, flows, guards and resets are declared in study_flow.py. These only
+# apply a transition; the caller reruns (once) when they return True, which
+# on_click callbacks get from Streamlit anyway.
 def next_step():
-    if st.session_state.flow == "original":
-        if st.session_state.step < 9:
-            st.session_state.step += 1
-            logging.info(f"Original flow: Moved to Step {st.session_state.step}")
-        else:
-            # End of scenario in original flow: increment scenario_count
-            st.session_state.scenario_count += 1
-            logging.info(f"Completed scenario {st.session_state.scenario_count - 1} in original flow")
-            if st.session_state.scenario_count > 5:
-                st.session_state.flow = "reordered"
-                st.session_state.new_step_index = 0
-                st.session_state.step = 2
-            else:
-                st.session_state.step = 2
-            reset_scenario_states()
-            st.rerun()
-    else:  # Reordered flow for scenarios 6–10
-        # Updated reorder flow now includes Step 7: [2, 5, 6, 3, 4, 7, 8, 9]
-        reorder_flow = [2, 5, 6, 3, 4, 7, 8, 9]
-        if st.session_state.new_step_index < len(reorder_flow) - 1:
-            st.session_state.new_step_index += 1
-            st.session_state.step = reorder_flow[st.session_state.new_step_index]
-            logging.info(f"Reordered flow: Moved to Step {st.session_state.step} (index {st.session_state.new_step_index})")
-        else:
-            st.session_state.scenario_count += 1
-            logging.info(f"Completed scenario {st.session_state.scenario_count - 1} in reordered flow")
-            if st.session_state.scenario_count > 10:
-                st.info("Study completed. Please refresh the page for the next round.")
-                st.stop()
-            else:
-                st.session_state.new_step_index = 0
-                st.session_state.step = reorder_flow[0]
-            reset_scenario_states()
-            st.rerun()
+    return transition(st.session_state, "next")
 
 def prev_step():
-    if st.session_state.flow == "original":
-        if st.session_state.step > 1:
-            st.session_state.step -= 1
-            st.session_state.timer_active = False
-            st.session_state.time_remaining = 300
-            logging.info(f"Original flow: Moved back to Step {st.session_state.step}")
-    else:
-        reorder_flow = [2, 5, 6, 3, 4, 7, 8, 9]
-        if st.session_state.new_step_index > 0:
-            st.session_state.new_step_index -= 1
-            st.session_state.step = reorder_flow[st.session_state.new_step_index]
-            logging.info(f"Reordered flow: Moved back to Step {st.session_state.step} (index {st.session_state.new_step_index})")
+    return transition(st.session_state, "back")
 
 def reset_scenario_states():
-    st.session_state.scenario = None
-    st.session_state.user_decision = None
-    st.session_state.model_prediction_label = None
-    st.session_state.override_reason = None
-    st.session_state.confirmation_feedback = None
-    st.session_state.feedback_shared = False
-    st.session_state.start_time = None
-    st.session_state.decision_time = None
-    st.session_state.submitted_decision = False
-    st.session_state.submitted_feedback = False
-    st.session_state.scenario_generated = False
-    st.session_state.model_generated = False
-    st.session_state.revealed_reasoning = False
-    st.session_state.raw_model_prediction = None
-    st.session_state.time_remaining = 300
+    apply_reset(st.session_state, SCENARIO_RESET)
+
+# ---------------------------
+# Step 4 Decision Timer
+# ---------------------------
+# The countdown is derived from a deadline kept in session state and drawn by
+# an auto-refreshing fragment, so only the countdown reruns every second. The
+# whole page reruns once more, when the deadline passes and the timeout is
+# recorded.
+def start_decision_timer():
+    st.session_state.start = time.time()
+    st.session_state.decision_deadline = st.session_state.start + DECISION_SECONDS
+    st.session_state.time_remaining = DECISION_SECONDS
+    st.session_state.timeout_handled = False
+    st.session_state.timer_active = True
+
+def stop_decision_timer():
+    apply_reset(st.session_state, TIMER_RESET)
+
+def seconds_remaining():
+    # Whole seconds left before the deadline (DECISION_SECONDS when no timer runs)
+    if st.session_state.decision_deadline is None:
+        return DECISION_SECONDS
+    return max(0, math.ceil(st.session_state.decision_deadline - time.time()))
+
+def expire_decision_timer():
+    # Records the timeout and moves on, once per scenario: whichever rerun
+    # (fragment or full page) first sees the deadline passed does it.
+    # Returns True when it did.
+    if st.session_state.timeout_handled or st.session_state.submitted_decision:
+        return False
+    st.session_state.timeout_handled = True
+    data = handle_timeout_decision()
+    save_data_to_google_sheet(data)
+    st.session_state.submitted_decision = True
     st.session_state.timer_active = False
-    st.session_state.start = None
+    st.session_state.time_remaining = 0
+    return next_step()
+
+def decision_header(remaining):
+    mins, secs = divmod(remaining, 60)
+    st.markdown(f"""
+        <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px;">
+            <div style="font-size: 20px; font-weight: bold; color: #003366;">
+                Step 4: Submit Decision
+            </div>
+            <div style="font-size: 18px; color: #8B0000;">
+                Time remaining - {mins:02d}:{secs:02d}
+            </div>
+        </div>
+    """, unsafe_allow_html=True)
+
+@st.fragment(run_every=1)
+def decision_timer():
+    # Stays on the page until the next full rerun; a decision submitted from
+    # decision_form() stops the countdown where it was
+    if st.session_state.timer_active:
+        st.session_state.time_remaining = seconds_remaining()
+    decision_header(st.session_state.time_remaining)
+    if st.session_state.timer_active and st.session_state.time_remaining == 0 and expire_decision_timer():
+        st.rerun()
 
 # ---------------------------
 # Feedback Handling Functions
@@ -432,18 +378,19 @@ def handle_submit_feedback():
         save_data_to_google_sheet(data)
         st.success("Your responses have been recorded. Thank you!")
         logging.info("Data saved successfully.")
-        next_step()
+        return next_step()
+    return False
 
 def handle_timeout_decision():
     st.session_state.user_decision = "No Decision - Time Expired"
-    st.session_state.decision_time = 300
+    st.session_state.decision_time = DECISION_SECONDS
     return {
         'Participant Decision': "No Decision - Time Expired",
         'Model Prediction': st.session_state.model_prediction_label,
         'Override Reason': st.session_state.override_reason,
         'Confirmation Feedback': "N/A - Timeout",
         'Additional Feedback': "Participant did not complete decision within time limit",
-        'Decision Time (seconds)': 300
+        'Decision Time (seconds)': DECISION_SECONDS
     }
 
 def handle_skip_feedback():
@@ -459,7 +406,140 @@ def handle_skip_feedback():
     save_data_to_google_sheet(data)
     st.success("Your responses have been recorded. Thank you!")
     logging.info("Data saved successfully.")
-    next_step()
+    return next_step()
+
+# ---------------------------
+# Step Fragments
+# ---------------------------
+# Each step's interactive area is a fragment: a click or widget change inside
+# it reruns only that fragment, not the CSS, header, progress bar and
+# scenario table around it. Buttons that change the step go through
+# nav_button(), which reruns the whole page once the step has changed.
+def nav_button(label, key, action, disabled=False):
+    # action() returns True when it moved to another step
+    if st.button(label, key=key, disabled=disabled) and action():
+        st.rerun()
+
+def generate_scenario():
+    try:
+        logging.info("Starting scenario generation")
+        # Same distribution as shuffling every parameter's columns and picking a row
+        st.session_state.scenario = get_scenario_sampler(columns_to_shuffle).sample()
+        st.session_state.start_time = time.time()
+        st.session_state.scenario_generated = True
+        st.success("Scenario generated successfully!")
+        logging.info("Generated new scenario.")
+    except Exception as e:
+        logging.error(f"Error in scenario generation: {e}")
+        st.error(f"Failed to generate scenario: {e}")
+
+@st.fragment
+def scenario_generator():
+    generate_button = st.button("Generate Scenario", key="generate_scenario")
+    if generate_button:
+        generate_scenario()
+    col_back, col_next = st.columns(2)
+    with col_back:
+        nav_button("Back", "back_step2", prev_step)
+    with col_next:
+        if st.session_state.scenario_generated:
+            nav_button("Next", "next_step2", next_step)
+        else:
+            nav_button("Next", "next_step2_disabled", next_step, disabled=True)
+
+def submit_decision():
+    if isinstance(st.session_state.start, float):
+        st.session_state.decision_time = DECISION_SECONDS - (time.time() - st.session_state.start)
+    else:
+        st.session_state.start = time.time()
+        st.session_state.decision_time = DECISION_SECONDS
+    st.session_state.time_remaining = seconds_remaining()
+    st.session_state.submitted_decision = True
+    st.session_state.timer_active = False
+    st.success("Decision submitted successfully!")
+
+@st.fragment
+def decision_form():
+    if seconds_remaining() > 0 or not st.session_state.timer_active:
+        user_decision = st.radio("", ["Engage", "Do Not Engage", "Ask Authorization", "Do Not Know"],
+                                 key="decision", help="Select the most appropriate decision based on the scenario.")
+        if user_decision:
+            st.session_state.user_decision = user_decision
+    else:
+        st.warning("Time's up! No more decisions allowed.")
+    col_back, col_submit = st.columns(2)
+    with col_back:
+        nav_button("Back", "back_step4", prev_step)
+    with col_submit:
+        if st.session_state.timer_active and not st.session_state.submitted_decision:
+            if st.button("Submit Decision", key="submit_decision"):
+                submit_decision()
+    if st.session_state.submitted_decision:
+        nav_button("Next", "next_step4", next_step)
+
+def generate_prediction():
+    try:
+        final_decision, reason, raw_model_pred = get_final_prediction(st.session_state.scenario)
+        if final_decision:
+            st.session_state.model_prediction_label = final_decision
+            st.session_state.override_reason = reason
+            st.session_state.raw_model_prediction = raw_model_pred
+            st.session_state.model_generated = True
+            st.success("Model prediction generated!")
+            st.write(get_markdown_text(f"<b>Model Decision</b>: {final_decision}", "decision_text"), unsafe_allow_html=True)
+            logging.info(f"Model prediction generated - Final: {final_decision}, Reason: {reason}")
+        else:
+            st.error("Could not generate prediction")
+    except Exception as e:
+        st.error(f"An error occurred during model prediction: {e}")
+        st.write("Error details:", str(e))
+        logging.error(f"Exception in Step 5: {e}")
+
+@st.fragment
+def prediction_generator():
+    if st.button("Generate Model Prediction", key="generate_prediction"):
+        generate_prediction()
+    col_back, col_next = st.columns(2)
+    with col_back:
+        nav_button("Back", "back_step5", prev_step)
+    with col_next:
+        if st.session_state.model_generated:
+            nav_button("Next", "next_step5", next_step)
+        else:
+            nav_button("Next", "next_step5_disabled", next_step, disabled=True)
+
+@st.fragment
+def confirmation_form():
+    feedback_options = [
+        "Strongly Disagree",
+        "Disagree",
+        "Neither Agree Nor Disagree",
+        "Agree",
+        "Strongly Agree"
+    ]
+    confirmation_feedback = st.radio("", feedback_options, key="confirmation_feedback_radio", help="Your feedback helps us improve the model.")
+    col_back, col_submit = st.columns(2)
+    with col_back:
+        nav_button("Back", "back_step7", prev_step)
+    with col_submit:
+        submit_feedback = st.button("Submit Feedback", key="submit_feedback")
+        if submit_feedback and confirmation_feedback:
+            st.session_state.confirmation_feedback = confirmation_feedback
+            st.session_state.submitted_feedback = True
+            st.success("Thank you for your feedback!")
+            logging.info(f"User feedback submitted: {confirmation_feedback}")
+    if st.session_state.submitted_feedback:
+        nav_button("Next", "next_step7", next_step)
+
+@st.fragment
+def additional_feedback_form():
+    st.text_area("", key="feedback_box", help="Share any additional thoughts or comments.")
+    col_back, col_submit = st.columns(2)
+    with col_back:
+        nav_button("Back", "back_step8", prev_step)
+    with col_submit:
+        nav_button("Submit Additional Feedback", "submit_feedback_additional", handle_submit_feedback)
+        nav_button("Skip", "skip_feedback", handle_skip_feedback)
 
 # ---------------------------
 # Main Application Function
@@ -519,8 +599,11 @@ def main():
     # Always show the title and scenario counter at the top
     st.markdown(get_markdown_text("Military Decision-Making App", "header"), unsafe_allow_html=True)
     logging.info("App started.")
+    if st.session_state.study_completed:
+        st.info("Study completed. Please refresh the page for the next round.")
+        return
     scenario_num = st.session_state.scenario_count
-    st.markdown(f"<h6 style='text-align:center; color:#003366;'>Scenario {scenario_num} of 10</h4>", unsafe_allow_html=True)
+    st.markdown(f"<h6 style='text-align:center; color:#003366;'>Scenario {scenario_num} of {TOTAL_SCENARIOS}</h4>", unsafe_allow_html=True)
     
     # Progress Indicator
     total_steps = 9
@@ -663,32 +746,7 @@ The App explores human-machine teaming in military contexts.
         logging.info("Entered Step 2: Generate Scenario.")
         st.markdown("<div class='step-title'>Step 2: Generate Scenario</div>", unsafe_allow_html=True)
         st.markdown(get_markdown_text("<i>Click the button below to generate a new scenario.</i>", "normal_text"), unsafe_allow_html=True)
-        generate_button = st.button("Generate Scenario", key="generate_scenario")
-        if generate_button:
-            try:
-                logging.info("Starting scenario generation")
-                st.session_state.df_shuffled = shuffle_dataset(df)
-                logging.info("Dataset shuffled successfully")
-                st.session_state.scenario = get_random_scenario(st.session_state.df_shuffled)
-                logging.info("Random scenario selected successfully")
-                if 'Total_Score' not in st.session_state.scenario or pd.isna(st.session_state.scenario['Total_Score']):
-                    st.session_state.scenario['Total_Score'] = st.session_state.scenario[score_columns].sum()
-                    logging.info("Calculated Total_Score for the scenario.")
-                st.session_state.start_time = time.time()
-                st.session_state.scenario_generated = True
-                st.success("Scenario generated successfully!")
-                logging.info("Generated new scenario.")
-            except Exception as e:
-                logging.error(f"Error in scenario generation: {e}")
-                st.error(f"Failed to generate scenario: {e}")
-        col_back, col_next = st.columns(2)
-        with col_back:
-            st.button("Back", key="back_step2", on_click=prev_step)
-        with col_next:
-            if st.session_state.scenario_generated:
-                st.button("Next", key="next_step2", on_click=next_step)
-            else:
-                st.button("Next", key="next_step2_disabled", on_click=next_step, disabled=True)
+        scenario_generator()
 
     # Step 3: Review Scenario
     elif st.session_state.step == 3:
@@ -706,91 +764,24 @@ The App explores human-machine teaming in military contexts.
     elif st.session_state.step == 4:
         logging.info("Entered Step 4: Submit Decision.")
         st.markdown(get_markdown_text("<i>Please review the scenario and select your decision below.</i>", "normal_text"), unsafe_allow_html=True)
-        if not st.session_state.timer_active:
-            st.session_state.time_remaining = 300
-            st.session_state.timer_active = True
-            st.session_state.start = time.time()
-        mins, secs = divmod(st.session_state.time_remaining, 60)
-        st.markdown(f"""
-            <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px;">
-                <div style="font-size: 20px; font-weight: bold; color: #003366;">
-                    Step 4: Submit Decision
-                </div>
-                <div style="font-size: 18px; color: #8B0000;">
-                    Time remaining - {mins:02d}:{secs:02d}
-                </div>
-            </div>
-        """, unsafe_allow_html=True)
-        display_scenario_with_scores(st.session_state.scenario)
-        if st.session_state.time_remaining > 0:
-            user_decision = st.radio("", ["Engage", "Do Not Engage", "Ask Authorization", "Do Not Know"],
-                                     key="decision", help="Select the most appropriate decision based on the scenario.")
-            if user_decision:
-                st.session_state.user_decision = user_decision
-        else:
-            st.warning("Time's up! No more decisions allowed.")
-        col_back, col_submit = st.columns(2)
-        with col_back:
-            st.button("Back", key="back_step4", on_click=prev_step)
-        with col_submit:
-            if st.session_state.time_remaining > 0:
-                submit_decision = st.button("Submit Decision", key="submit_decision")
-                if submit_decision:
-                    if isinstance(st.session_state.start, float):
-                        st.session_state.decision_time = 300 - (time.time() - st.session_state.start)
-                    else:
-                        st.session_state.start = time.time()
-                        st.session_state.decision_time = 300
-                    st.session_state.submitted_decision = True
-                    st.session_state.timer_active = False
-                    st.success("Decision submitted successfully!")
-        if st.session_state.submitted_decision:
-            st.button("Next", key="next_step4", on_click=next_step)
-        if st.session_state.timer_active and st.session_state.time_remaining > 0:
-            time.sleep(1)
-            st.session_state.time_remaining -= 1
-            if st.session_state.time_remaining == 0:
-                if not st.session_state.submitted_decision:
-                    data = handle_timeout_decision()
-                    save_data_to_google_sheet(data)
-                    st.warning("Time's up! Decision auto-submitted.")
-                    st.session_state.submitted_decision = True
-                    st.session_state.timer_active = False
-                st.session_state.step += 1
+        if not st.session_state.timer_active and not st.session_state.submitted_decision:
+            start_decision_timer()
+        if st.session_state.timer_active and seconds_remaining() == 0 and expire_decision_timer():
+            # Deadline passed while the countdown was not running (e.g. the tab was closed)
             st.rerun()
+        if st.session_state.timer_active:
+            decision_timer()
+        else:
+            decision_header(st.session_state.time_remaining)
+        display_scenario_with_scores(st.session_state.scenario)
+        decision_form()
 
     # Step 5: Generate Model Prediction
     elif st.session_state.step == 5:
         logging.info("Entered Step 5: Generate Model Prediction.")
         st.markdown("<div class='step-title'>Step 5: Generate Model Prediction</div>", unsafe_allow_html=True)
         st.write(get_markdown_text(f"<b>Your Decision</b>: {st.session_state.user_decision}", "decision_text"), unsafe_allow_html=True)
-        generate_prediction = st.button("Generate Model Prediction", key="generate_prediction")
-        if generate_prediction:
-            try:
-                scenario_data = pd.DataFrame([{col: st.session_state.scenario[col] for col in trained_feature_columns}])
-                final_decision, reason, raw_model_pred = get_final_prediction(scenario_data, rf_model_loaded)
-                if final_decision:
-                    st.session_state.model_prediction_label = final_decision
-                    st.session_state.override_reason = reason
-                    st.session_state.raw_model_prediction = raw_model_pred
-                    st.session_state.model_generated = True
-                    st.success("Model prediction generated!")
-                    st.write(get_markdown_text(f"<b>Model Decision</b>: {final_decision}", "decision_text"), unsafe_allow_html=True)
-                    logging.info(f"Model prediction generated - Final: {final_decision}, Reason: {reason}")
-                else:
-                    st.error("Could not generate prediction")
-            except Exception as e:
-                st.error(f"An error occurred during model prediction: {e}")
-                st.write("Error details:", str(e))
-                logging.error(f"Exception in Step 5: {e}")
-        col_back, col_next = st.columns(2)
-        with col_back:
-            st.button("Back", key="back_step5", on_click=prev_step)
-        with col_next:
-            if st.session_state.model_generated:
-                st.button("Next", key="next_step5", on_click=next_step)
-            else:
-                st.button("Next", key="next_step5_disabled", on_click=next_step, disabled=True)
+        prediction_generator()
 
     # Step 6: Reveal Model Reasoning
     elif st.session_state.step == 6:
@@ -810,7 +801,12 @@ The App explores human-machine teaming in military contexts.
                 "highlighted_text"
             ), unsafe_allow_html=True)
 
-        display_scenario_with_scores(st.session_state.scenario, feature_importances=rf_model_loaded.feature_importances_ if hasattr(rf_model_loaded, 'feature_importances_') else None, override_reason=st.session_state.override_reason)
+        explanation = None
+        try:
+            explanation = explain_scenario(st.session_state.scenario)
+        except Exception as e:
+            logging.error(f"Error explaining model prediction: {e}")
+        display_scenario_with_scores(st.session_state.scenario, explanation=explanation, override_reason=st.session_state.override_reason)
         help_container = st.container()
         with help_container:
             col1, col2 = st.columns([0.97, 0.03])
@@ -852,60 +848,21 @@ The App explores human-machine teaming in military contexts.
         if st.session_state.override_reason and "No override rules applied" not in st.session_state.override_reason:
             st.markdown(get_markdown_text(f"Override Rule Applied: {st.session_state.override_reason}", "highlighted_text"), unsafe_allow_html=True)
         st.markdown(get_markdown_text("Do you agree with the model's prediction?", "normal_text"), unsafe_allow_html=True)
-        feedback_options = [
-            "Strongly Disagree",
-            "Disagree",
-            "Neither Agree Nor Disagree",
-            "Agree",
-            "Strongly Agree"
-        ]
-        confirmation_feedback = st.radio("", feedback_options, key="confirmation_feedback_radio", help="Your feedback helps us improve the model.")
-        col_back, col_submit = st.columns(2)
-        with col_back:
-            st.button("Back", key="back_step7", on_click=prev_step)
-        with col_submit:
-            submit_feedback = st.button("Submit Feedback", key="submit_feedback")
-            if submit_feedback and confirmation_feedback:
-                st.session_state.confirmation_feedback = confirmation_feedback
-                st.session_state.submitted_feedback = True
-                st.success("Thank you for your feedback!")
-                logging.info(f"User feedback submitted: {confirmation_feedback}")
-        if st.session_state.submitted_feedback:
-            st.button("Next", key="next_step7", on_click=next_step)
+        confirmation_form()
 
     # Step 8: Share Additional Feedback
     elif st.session_state.step == 8:
         logging.info("Entered Step 8: Share Additional Feedback.")
         st.markdown("<div class='step-title'>Step 8: Share Additional Feedback</div>", unsafe_allow_html=True)
         st.markdown(get_markdown_text("Please provide any additional thoughts or comments below.", "normal_text"), unsafe_allow_html=True)
-        st.text_area("", key="feedback_box", help="Share any additional thoughts or comments.")
-        col_back, col_submit = st.columns(2)
-        with col_back:
-            st.button("Back", key="back_step8", on_click=prev_step)
-        with col_submit:
-            st.button("Submit Additional Feedback", key="submit_feedback_additional", on_click=handle_submit_feedback)
-            st.button("Skip", key="skip_feedback", on_click=handle_skip_feedback)
+        additional_feedback_form()
 
     # Step 9: Completion – update scenario counter here
     elif st.session_state.step == 9:
         logging.info("Entered Step 9: Completion.")
         st.markdown(get_markdown_text("You have completed all steps for this scenario.", "subheader"), unsafe_allow_html=True)
         st.write("Thank you for participating in this scenario.")
-        message_placeholder = st.empty()
-        if st.button("Start New Scenario", key="start_new_scenario_button"):
-            st.session_state.scenario_count += 1
-            if st.session_state.scenario_count > 10:
-                st.info("Study completed. Please refresh the page for the next round.")
-                st.stop()
-            else:
-                if st.session_state.scenario_count <= 5:
-                    st.session_state.flow = "original"
-                else:
-                    st.session_state.flow = "reordered"
-                    st.session_state.new_step_index = 0
-                st.session_state.step = 2
-                reset_scenario_states()
-                st.rerun()
+        st.button("Start New Scenario", key="start_new_scenario_button", on_click=next_step)
     else:
         st.markdown("Other steps here...")
 
@@ -0,0 +1,395 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+import pandas as pd
+from model_logic import labels, features_from_scores, batch_result
+from model_store import registry, get_model
+from scenario_encoder import encoder, UNKNOWN_CODE, CODE_DTYPE
+from override_rules import RULE_COLUMNS, apply_override_rules_batch, assign_final_decision_batch
+
+# ---------------------------
+# Offline batch scorer
+# ---------------------------
+# python batch_score.py scenarios.csv scored.csv [--overrides] [--thresholds]
+#
+# Reads CSV, JSONL or Parquet scenarios (raw labels, same columns as the
+# dataset or the API) CHUNK_ROWS at a time. Every chunk is parsed, encoded,
+# scored and serialized by a worker process, and the results are written
+# in input order in the input's format with these columns appended:
+#   Error, Prediction_Code, Prediction_Label, Margin, Probability_<class>,
+#   Override_Decision/Override_Reason (--overrides), Score_Decision (--thresholds),
+#   Final_Decision (override, else threshold or model decision)
+# After every written chunk the input position and output size are saved to
+# <output>.checkpoint.json; running the same command again resumes from there.
+# CSV and JSONL inputs are split on newlines, so CSV fields must not contain
+# line breaks. Parquet needs pyarrow.
+
+CHUNK_ROWS = 65536
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet"}
+# Seconds between progress lines
+REPORT_INTERVAL = 5.0
+
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise SystemExit(f"Unsupported file type {extension!r}, expected one of {sorted(FORMATS)}")
+    return FORMATS[extension]
+
+
+# ---------------------------
+# Worker side
+# ---------------------------
+def _init_worker(version, sha256):
+    loaded = get_model(version)
+    if loaded.sha256 != sha256:
+        registry.scan()
+
+
+def encode_labels(frame):
+    # Like encoder.encode_columns, but labels are compared as stripped strings:
+    # the dataset spells some of them " 1-10" and Parquet/JSON may hold numbers
+    codes = np.empty((len(frame), len(encoder.features)), dtype=CODE_DTYPE)
+    for index, feature in enumerate(encoder.features):
+        value_codes, uniques = frame[feature.column].factorize()
+        remap = np.array(
+            [feature.codes.get(str(value).strip(), UNKNOWN_CODE) for value in uniques] + [UNKNOWN_CODE], dtype=CODE_DTYPE
+        )
+        codes[:, index] = remap.take(value_codes)
+    return codes
+
+
+def score_frame(frame, options):
+    # Input frame -> the same frame with the result columns appended
+    loaded = get_model(options["version"])
+    if loaded.sha256 != options["sha256"]:
+        raise RuntimeError(f"Model version {loaded.version} changed during the run ({loaded.sha256[:12]})")
+    n_rows = len(frame)
+    missing = [column for column in encoder.columns if column not in frame.columns]
+    if missing:
+        raise ValueError(f"Missing scenario columns: {missing}")
+    codes = encode_labels(frame)
+    unknown = codes == UNKNOWN_CODE
+    invalid = unknown.any(axis=1)
+    errors = np.full(n_rows, None, dtype=object)
+    for position in np.flatnonzero(invalid):
+        column = encoder.columns[unknown[position].argmax()]
+        errors[position] = f"Unknown {column} value: {frame[column].iloc[position]!r}"
+    scores = encoder.scores_from_codes(codes)
+    valid = ~invalid
+
+    out = frame.copy()
+    out["Error"] = pd.Series(errors, index=frame.index, dtype=object)
+    class_names = [labels[code] for code in loaded.forest.classes]
+    prediction_code = np.full(n_rows, np.nan)
+    prediction_label = np.full(n_rows, None, dtype=object)
+    margin = np.full(n_rows, np.nan)
+    probabilities = np.full((n_rows, len(class_names)), np.nan)
+    if valid.any():
+        features = features_from_scores(scores[valid], loaded)
+        batch = batch_result(loaded, *loaded.forest.predict_details(features))
+        prediction_code[valid] = batch["prediction_code"]
+        prediction_label[valid] = batch["prediction_label"]
+        margin[valid] = batch["margin"]
+        probabilities[valid] = batch["probabilities"]
+    out["Prediction_Code"] = pd.array(prediction_code, dtype="Int64")
+    out["Prediction_Label"] = pd.Series(prediction_label, index=frame.index, dtype=object)
+    out["Margin"] = margin
+    for index, class_name in enumerate(class_names):
+        out[f"Probability_{class_name.replace(' ', '_')}"] = probabilities[:, index]
+
+    final = prediction_label.copy()
+    if options["thresholds"]:
+        score_decision = assign_final_decision_batch(scores[:, -1])
+        score_decision[invalid] = None
+        out["Score_Decision"] = pd.Series(score_decision, index=frame.index, dtype=object)
+        final = score_decision.copy()
+    if options["overrides"]:
+        rule_frame = frame[RULE_COLUMNS].copy()
+        rule_frame["Total_Score"] = scores[:, -1]
+        decisions, reasons = apply_override_rules_batch(rule_frame)
+        decisions = np.array(decisions, dtype=object)
+        reasons = np.array(reasons, dtype=object)
+        decisions[invalid] = None
+        reasons[invalid] = None
+        out["Override_Decision"] = pd.Series(decisions, index=frame.index, dtype=object)
+        out["Override_Reason"] = pd.Series(reasons, index=frame.index, dtype=object)
+        overridden = pd.notna(decisions)
+        final[overridden] = decisions[overridden]
+    if options["overrides"] or options["thresholds"]:
+        out["Final_Decision"] = pd.Series(final, index=frame.index, dtype=object)
+    return out
+
+
+def score_lines(fmt, header, body, options):
+    # One raw CSV/JSONL chunk -> (serialized result lines, header line, rows)
+    if fmt == "csv":
+        frame = pd.read_csv(io.BytesIO(header + body), dtype=str, keep_default_na=False)
+        out = score_frame(frame, options)
+        return out.to_csv(index=False, header=False).encode(), out.iloc[:0].to_csv(index=False).encode(), len(out)
+    records = []
+    parse_errors = {}
+    for position, line in enumerate(line for line in body.splitlines() if line.strip()):
+        try:
+            records.append(json.loads(line))
+        except ValueError as e:
+            records.append({})
+            parse_errors[position] = f"Invalid JSON: {e}"
+    frame = pd.DataFrame.from_records(records)
+    for column in encoder.columns:
+        if column not in frame.columns:
+            frame[column] = None
+    out = score_frame(frame, options)
+    for position, message in parse_errors.items():
+        out.iat[position, out.columns.get_loc("Error")] = message
+    if not len(out):
+        return b"", b"", 0
+    return out.to_json(orient="records", lines=True).encode(), b"", len(out)
+
+
+def score_table(frame, options):
+    out = score_frame(frame, options)
+    return out, len(out)
+
+
+# ---------------------------
+# Reading & writing
+# ---------------------------
+def line_chunks(path, fmt, position, chunk_rows):
+    # ((header, body), input byte offset after the body) per chunk of lines
+    with open(path, "rb") as f:
+        header = f.readline() if fmt == "csv" else b""
+        f.seek(max(position, f.tell()))
+        while True:
+            lines = list(islice(f, chunk_rows))
+            if not lines:
+                return
+            body = b"".join(lines)
+            if not body.endswith(b"\n"):
+                body += b"\n"
+            yield (header, body), f.tell()
+
+
+def parquet_chunks(path, position, chunk_rows):
+    # (frame,) and rows read so far, starting after the first `position` rows
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(path)
+    skip = position
+    groups = []
+    for group in range(parquet.num_row_groups):
+        group_rows = parquet.metadata.row_group(group).num_rows
+        if skip >= group_rows:
+            skip -= group_rows
+        else:
+            groups.append(group)
+    done = position
+    if not groups:
+        return
+    for batch in parquet.iter_batches(batch_size=chunk_rows, row_groups=groups):
+        if skip:
+            dropped = min(skip, batch.num_rows)
+            batch = batch.slice(dropped)
+            skip -= dropped
+            if not batch.num_rows:
+                continue
+        done += batch.num_rows
+        yield (batch.to_pandas(),), done
+
+
+class Checkpoint:
+    # Progress of one output file, rewritten atomically after every chunk
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        self.position = 0
+        self.rows = 0
+        self.written = 0
+        self.parts = 0
+
+    def load(self):
+        # True when a checkpoint for this exact job exists
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get("job") != self.job:
+            raise SystemExit(f"{self.path} belongs to a different input, model or options; use --restart")
+        self.position, self.rows, self.written, self.parts = saved["position"], saved["rows"], saved["written"], saved["parts"]
+        return True
+
+    def save(self):
+        state = {"job": self.job, "position": self.position, "rows": self.rows, "written": self.written, "parts": self.parts}
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class LinesOutput:
+    # CSV/JSONL output appended chunk by chunk; a resumed run first cuts off
+    # anything written after the last checkpoint
+    def __init__(self, path, checkpoint):
+        mode = "r+b" if checkpoint.written and os.path.exists(path) else "wb"
+        self.file = open(path, mode)
+        self.file.truncate(checkpoint.written)
+        self.file.seek(checkpoint.written)
+        self.checkpoint = checkpoint
+
+    def write(self, result):
+        data, header, _ = result
+        if self.checkpoint.written == 0 and header:
+            self.file.write(header)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.checkpoint.written = self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    # Every chunk is written as its own part file; finish() copies the parts
+    # into the output file, one row group each
+    def __init__(self, path, checkpoint):
+        self.path = path
+        self.parts_dir = path + ".parts"
+        self.checkpoint = checkpoint
+        if not checkpoint.parts and os.path.isdir(self.parts_dir):
+            shutil.rmtree(self.parts_dir)
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+    def part_path(self, number):
+        return os.path.join(self.parts_dir, f"part-{number:08d}.parquet")
+
+    def write(self, result):
+        frame, _ = result
+        frame.to_parquet(self.part_path(self.checkpoint.parts), index=False)
+        self.checkpoint.parts += 1
+
+    def finish(self):
+        import pyarrow.parquet as pq
+        writer = None
+        for number in range(self.checkpoint.parts):
+            table = pq.read_table(self.part_path(number))
+            if writer is None:
+                writer = pq.ParquetWriter(self.path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(self.parts_dir)
+
+    def close(self):
+        pass
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+def run(input_path, output_path, overrides=False, thresholds=False, processes=None, chunk_rows=CHUNK_ROWS,
+        model_version=None, restart=False):
+    fmt = file_format(input_path)
+    if file_format(output_path) != fmt:
+        raise SystemExit("The output must use the same format as the input")
+    loaded = get_model(model_version)
+    options = {"version": loaded.version, "sha256": loaded.sha256, "overrides": overrides, "thresholds": thresholds}
+    stat = os.stat(input_path)
+    job = dict(options, input=os.path.abspath(input_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns, chunk_rows=chunk_rows)
+    checkpoint = Checkpoint(output_path + ".checkpoint.json", job)
+    if restart:
+        checkpoint.remove()
+    elif checkpoint.load():
+        print(f"Resuming after {checkpoint.rows} rows", file=sys.stderr)
+
+    if fmt == "parquet":
+        chunks = parquet_chunks(input_path, checkpoint.position, chunk_rows)
+        output = ParquetOutput(output_path, checkpoint)
+    else:
+        chunks = line_chunks(input_path, fmt, checkpoint.position, chunk_rows)
+        output = LinesOutput(output_path, checkpoint)
+
+    processes = processes or os.cpu_count() or 1
+    started = time.perf_counter()
+    reported = started
+    rows_at_start = checkpoint.rows
+    # Chunks in flight, oldest first; results are written strictly in this order
+    in_flight = deque()
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(loaded.version, loaded.sha256),
+    ) as pool:
+        def next_future(payload):
+            if fmt == "parquet":
+                return pool.submit(score_table, *payload, options)
+            return pool.submit(score_lines, fmt, *payload, options)
+
+        def write_oldest():
+            nonlocal reported
+            future, end_position = in_flight.popleft()
+            result = future.result()
+            output.write(result)
+            checkpoint.position = end_position
+            checkpoint.rows += result[-1]
+            checkpoint.save()
+            now = time.perf_counter()
+            if now - reported >= REPORT_INTERVAL:
+                reported = now
+                rate = (checkpoint.rows - rows_at_start) / (now - started)
+                print(f"{checkpoint.rows} rows scored, {rate:.0f} rows/s", file=sys.stderr)
+
+        try:
+            for payload, end_position in chunks:
+                in_flight.append((next_future(payload), end_position))
+                if len(in_flight) >= 2 * processes:
+                    write_oldest()
+            while in_flight:
+                write_oldest()
+        finally:
+            for future, _ in in_flight:
+                future.cancel()
+            output.close()
+    if fmt == "parquet":
+        output.finish()
+    checkpoint.remove()
+    elapsed = time.perf_counter() - started
+    rows = checkpoint.rows - rows_at_start
+    print(f"Scored {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s), "
+          f"{checkpoint.rows} in {output_path}", file=sys.stderr)
+    return checkpoint.rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a CSV, JSONL or Parquet file of scenarios.")
+    parser.add_argument("input")
+    parser.add_argument("output", help="Same format as the input")
+    parser.add_argument("--overrides", action="store_true", help="Apply the legal & ethical override rules")
+    parser.add_argument("--thresholds", action="store_true", help="Add the Total_Score threshold decision")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--model-version", default=None, help="Registry version (default: the active one)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args(argv)
+    run(args.input, args.output, overrides=args.overrides, thresholds=args.thresholds, processes=args.processes,
+        chunk_rows=args.chunk_rows, model_version=args.model_version, restart=args.restart)
+
+
+if __name__ == "__main__":
+    main()
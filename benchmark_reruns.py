@@ -0,0 +1,96 @@
+import argparse
+import os
+import time
+from streamlit.testing.v1 import AppTest
+
+# ---------------------------
+# Full-page vs fragment rerun cost
+# ---------------------------
+# python benchmark_reruns.py [--repeat 30] [--interactions 6]
+# Drives app_main.py through the study steps with Streamlit's AppTest and
+# measures the server CPU (process time) of one full script rerun on each
+# step against one rerun of the fragment that owns that step's widgets, with
+# the test harness's own cost (an empty script) subtracted from both. The
+# per-minute figures assume a participant makes --interactions widget changes
+# per minute; on step 4 the countdown adds one timer rerun per second.
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_main.py")
+
+# step -> (buttons that reach it from the previous step, fragment with its widgets)
+STEPS = [
+    (2, ["proceed_to_scenario_generation"], "scenario_generator"),
+    (4, ["generate_scenario", "next_step2", "proceed_to_decision_step3"], "decision_form"),
+    (5, ["submit_decision", "next_step4"], "prediction_generator"),
+    (7, ["generate_prediction", "next_step5", "next_step6"], "confirmation_form"),
+    (8, ["submit_feedback", "next_step7"], "additional_feedback_form"),
+]
+
+
+def noop():
+    pass
+
+
+def run_fragment(name):
+    import app_main
+    getattr(app_main, name)()
+
+
+def cpu_per_run(app, repeat):
+    app.run()
+    started = time.process_time()
+    for _ in range(repeat):
+        app.run()
+    return (time.process_time() - started) / repeat
+
+
+def fragment_app(name, source):
+    # The fragment alone, against a copy of the session it would run in
+    app = AppTest.from_function(run_fragment, args=(name,), default_timeout=30)
+    # Button states can't be assigned, everything else is copied over
+    buttons = {button.key for button in source.button}
+    for key in source.session_state:
+        if key not in buttons:
+            app.session_state[key] = source.session_state[key]
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-page vs fragment rerun CPU of the study app")
+    parser.add_argument("--repeat", type=int, default=30, help="reruns timed per measurement")
+    parser.add_argument("--interactions", type=float, default=6, help="widget changes per participant-minute")
+    args = parser.parse_args()
+
+    harness = cpu_per_run(AppTest.from_function(noop, default_timeout=30), args.repeat)
+    app = AppTest.from_file(APP, default_timeout=30)
+    app.run()
+    print(f"{'step':>4} {'fragment':>26} {'full ms':>8} {'frag ms':>8} {'full ms/min':>12} {'frag ms/min':>12}")
+    totals = [0.0, 0.0]
+    for step, buttons, fragment in STEPS:
+        for key in buttons:
+            app.button(key=key).click().run()
+        assert app.session_state.step == step, (step, app.session_state.step, app.exception)
+        full = max(cpu_per_run(app, args.repeat) - harness, 0.0)
+        partial = max(cpu_per_run(fragment_app(fragment, app), args.repeat) - harness, 0.0)
+        reruns = args.interactions
+        timer = 0.0
+        if step == 4:
+            # Before: every countdown tick reran the page; now only decision_timer runs
+            timer = cpu_per_run(fragment_app("decision_timer", app), args.repeat) - harness
+            full_minute = (reruns + 60) * full
+            fragment_minute = reruns * partial + 60 * max(timer, 0.0)
+        else:
+            full_minute = reruns * full
+            fragment_minute = reruns * partial
+        totals[0] += full_minute
+        totals[1] += fragment_minute
+        print(f"{step:>4} {fragment:>26} {full * 1000:8.2f} {partial * 1000:8.2f} "
+              f"{full_minute * 1000:12.1f} {fragment_minute * 1000:12.1f}")
+        if step == 4:
+            app.radio(key="decision").set_value("Engage").run()
+    print(f"Harness overhead per run: {harness * 1000:.2f} ms")
+    print(f"CPU per participant-minute, averaged over the steps: {totals[0] / len(STEPS) * 1000:.1f} ms full-page, "
+          f"{totals[1] / len(STEPS) * 1000:.1f} ms with fragments ({totals[0] / max(totals[1], 1e-9):.1f}x less)")
+
+
+if __name__ == "__main__":
+    main()
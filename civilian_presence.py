@@ -0,0 +1,71 @@
+import re
+import threading
+import numpy as np
+from mappings_fixed import Civilian_Presence_Map
+
+# ---------------------------
+# Civilian_Presence intervals
+# ---------------------------
+# Civilian_Presence labels are estimated head counts: "0", "1-10",
+# "100-200", ">100". Each distinct label is parsed once into an integer
+# (low, high) interval, high None when open-ended, and every rule compares
+# those integers instead of re-parsing strings. Displays keep the label itself:
+# an interval cannot tell ">100" from "101+".
+
+_RANGE = re.compile(r"(\d+)\s*-\s*(\d+)")
+_COUNT = re.compile(r"\d+")
+_MORE_THAN = re.compile(r">\s*(\d+)")
+_AT_LEAST = re.compile(r"(?:>=\s*(\d+))|(?:(\d+)\s*\+)")
+
+
+def parse_interval(label):
+    # Label -> (low, high), None when it is missing or not a head count
+    if isinstance(label, (bool, np.bool_)):
+        return None
+    if isinstance(label, (int, np.integer)):
+        return int(label), int(label)
+    if isinstance(label, (float, np.floating)):
+        if not np.isfinite(label):
+            return None
+        return int(label), int(label)
+    if not isinstance(label, str):
+        return None
+    text = label.strip()
+    match = _RANGE.fullmatch(text)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    if _COUNT.fullmatch(text):
+        return int(text), int(text)
+    match = _MORE_THAN.fullmatch(text)
+    if match:
+        return int(match.group(1)) + 1, None
+    match = _AT_LEAST.fullmatch(text)
+    if match:
+        return int(match.group(1) or match.group(2)), None
+    return None
+
+
+# Label -> interval, seeded from the mapping; other spellings (the dataset
+# has " 1-10") are added the first time they are seen
+CIVILIAN_PRESENCE_INTERVALS = {label: parse_interval(label) for label in Civilian_Presence_Map}
+_intervals = dict(CIVILIAN_PRESENCE_INTERVALS)
+_lock = threading.Lock()
+
+
+def civilian_presence_interval(label):
+    try:
+        return _intervals[label]
+    except KeyError:
+        interval = parse_interval(label)
+        with _lock:
+            _intervals[label] = interval
+        return interval
+    except TypeError:
+        # Unhashable values are never valid labels
+        return None
+
+
+def register_labels(labels):
+    # Parse a column's distinct labels up front, e.g. when the dataset loads
+    for label in labels:
+        civilian_presence_interval(label)
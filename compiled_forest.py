@@ -0,0 +1,313 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# ---------------------------
+# Array-based RandomForest evaluator
+# ---------------------------
+# Every DecisionTreeClassifier in the forest is flattened into one set of
+# contiguous node arrays. Leaves point back at themselves, so walking
+# max_depth steps from each root lands every (tree, row) pair on its leaf.
+
+ARRAY_NAMES = ["feature", "threshold", "left", "right", "value", "roots", "classes"]
+# Derived arrays used by apply(); saved too so a memory-mapped load shares them
+TRAVERSAL_NAMES = ["feature2", "threshold2", "children2", "roots2"]
+META_FILE = "meta.json"
+# Rows evaluated per block, bounds the (trees x rows x classes) leaf-value temporary
+BLOCK_ROWS = 4096
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CompiledForest:
+    def __init__(self, feature, threshold, left, right, value, roots, classes, max_depth, n_features,
+                 source_sha256=None, feature_names=None, feature2=None, threshold2=None, children2=None, roots2=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.classes = classes
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.source_sha256 = source_sha256
+        # Column names the forest was fitted on, when sklearn recorded them
+        self.feature_names = feature_names
+        # Traversal works on doubled node ids: slot 2*node + go_right of
+        # children2 holds the doubled id of the next node, so one flat gather
+        # per level picks the child.
+        self.feature2 = np.repeat(feature, 2) if feature2 is None else feature2
+        self.threshold2 = np.repeat(threshold, 2) if threshold2 is None else threshold2
+        self.children2 = 2 * np.stack([left, right], axis=1).ravel() if children2 is None else children2
+        self.roots2 = 2 * roots if roots2 is None else roots2
+        self._gain2 = None
+
+    @property
+    def n_estimators(self):
+        return len(self.roots)
+
+    def _as_matrix(self, X):
+        # Trees compare float32 features against float64 thresholds, same as sklearn
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[np.newaxis, :]
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {X.shape[1]}")
+        return X
+
+    def apply(self, X):
+        # Leaf index of every (tree, row) pair, shape (n_estimators, n_rows)
+        X = self._as_matrix(X)
+        n_rows = X.shape[0]
+        # Feature-major copy so one flat gather fetches X[row, feature[node]]
+        flat_X = X.T.ravel()
+        feature_offset = self.feature2 * n_rows
+        rows = np.arange(n_rows)
+        node2 = np.repeat(self.roots2[:, np.newaxis], n_rows, axis=1)
+        for _ in range(self.max_depth):
+            go_right = flat_X[feature_offset[node2] + rows] > self.threshold2[node2]
+            node2 = self.children2[node2 + go_right]
+        return node2 // 2
+
+    def predict_details(self, X):
+        # (probabilities, votes) from one traversal, both shaped (n_rows, n_classes).
+        # Tree probabilities are accumulated in estimator order and then
+        # averaged, which reproduces RandomForestClassifier.predict_proba bit for bit;
+        # votes count the trees whose own argmax is each class.
+        X = self._as_matrix(X)
+        if X.shape[0] > BLOCK_ROWS:
+            blocks = [self.predict_details(X[start:start + BLOCK_ROWS]) for start in range(0, X.shape[0], BLOCK_ROWS)]
+            return np.concatenate([proba for proba, _ in blocks]), np.concatenate([votes for _, votes in blocks])
+        per_tree = self.value[self.apply(X)]
+        proba = per_tree.sum(axis=0) / self.n_estimators
+        tree_choice = per_tree.argmax(axis=2)
+        votes = (tree_choice[:, :, np.newaxis] == np.arange(len(self.classes))).sum(axis=0)
+        return proba, votes
+
+    @property
+    def gain2(self):
+        # Change in the tree's class distribution when a split sends a row to
+        # a child, laid out like children2 (zero on leaves). Built on first use.
+        if self._gain2 is None:
+            value2 = np.repeat(self.value, 2, axis=0)
+            self._gain2 = self.value[self.children2 // 2] - value2
+        return self._gain2
+
+    def explain(self, X):
+        # Saabas-style path attribution: each split's change in class
+        # distribution is credited to its feature. Returns (bias, contributions)
+        # shaped (n_classes,) and (n_rows, n_features, n_classes), where
+        # bias + contributions.sum(axis=1) equals predict_proba(X).
+        X = self._as_matrix(X)
+        if X.shape[0] > BLOCK_ROWS:
+            blocks = [self.explain(X[start:start + BLOCK_ROWS]) for start in range(0, X.shape[0], BLOCK_ROWS)]
+            return blocks[0][0], np.concatenate([contributions for _, contributions in blocks])
+        n_rows = X.shape[0]
+        n_classes = len(self.classes)
+        flat_X = X.T.ravel()
+        feature_offset = self.feature2 * n_rows
+        rows = np.arange(n_rows)
+        # Every split is accumulated into a flat (row, feature) slot per class
+        row_slot = rows * self.n_features
+        slots, gains = [], []
+        node2 = np.repeat(self.roots2[:, np.newaxis], n_rows, axis=1)
+        for _ in range(self.max_depth):
+            step = node2 + (flat_X[feature_offset[node2] + rows] > self.threshold2[node2])
+            slots.append(self.feature2[node2] + row_slot)
+            gains.append(self.gain2[step])
+            node2 = self.children2[step]
+        slots = np.concatenate(slots, axis=None)
+        gains = np.concatenate(gains, axis=None).reshape(-1, n_classes)
+        n_slots = n_rows * self.n_features
+        contributions = np.stack([
+            np.bincount(slots, weights=gains[:, index], minlength=n_slots) for index in range(n_classes)
+        ], axis=1)
+        bias = self.value[self.roots].mean(axis=0)
+        return bias, contributions.reshape(n_rows, self.n_features, n_classes) / self.n_estimators
+
+    def predict_proba(self, X):
+        return self.predict_details(X)[0]
+
+    def predict(self, X):
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES + TRAVERSAL_NAMES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        meta = {
+            "max_depth": self.max_depth,
+            "n_features": self.n_features,
+            "source_sha256": self.source_sha256,
+            "feature_names": self.feature_names,
+        }
+        with open(os.path.join(directory, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        # mmap_mode="r" maps the .npy files read-only, so every process that
+        # loads the same directory shares one copy of the pages
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in ARRAY_NAMES + TRAVERSAL_NAMES:
+            path = os.path.join(directory, f"{name}.npy")
+            if name in ARRAY_NAMES or os.path.exists(path):
+                # Plain ndarray views of the mapping: indexing np.memmap
+                # itself wraps every small result in a memmap subclass
+                arrays[name] = np.asarray(np.load(path, mmap_mode=mmap_mode))
+        return cls(**arrays, **meta)
+
+
+def top_two_margin(proba):
+    # Gap between the two most likely classes, per row
+    top_two = np.sort(proba, axis=-1)[..., -2:]
+    return top_two[..., 1] - top_two[..., 0]
+
+
+def compile_forest(rf_model, source_sha256=None):
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in rf_model.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        own_index = np.arange(tree.node_count) + offset
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+        lefts.append(np.where(is_leaf, own_index, tree.children_left + offset))
+        rights.append(np.where(is_leaf, own_index, tree.children_right + offset))
+        # Same per-leaf normalisation as DecisionTreeClassifier.predict_proba
+        proba = tree.value[:, 0, :]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(proba / normalizer)
+        roots.append(offset)
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+    return CompiledForest(
+        feature=np.concatenate(features).astype(np.intp),
+        threshold=np.concatenate(thresholds).astype(np.float64),
+        left=np.concatenate(lefts).astype(np.intp),
+        right=np.concatenate(rights).astype(np.intp),
+        value=np.concatenate(values).astype(np.float64),
+        roots=np.asarray(roots, dtype=np.intp),
+        classes=np.asarray(rf_model.classes_),
+        max_depth=max_depth,
+        n_features=rf_model.n_features_in_,
+        source_sha256=source_sha256,
+        feature_names=[str(name) for name in getattr(rf_model, "feature_names_in_", [])] or None,
+    )
+
+
+def publish_forest(forest, compiled_path):
+    # Compiled copies live in <compiled_path>/<source sha256>/ and are never
+    # written once they exist: other versions (and other processes) may have
+    # their files memory-mapped. A copy is saved into a private temporary
+    # directory and renamed into place, so readers see all of it or none;
+    # when another process published the same model first, its copy is kept.
+    os.makedirs(compiled_path, exist_ok=True)
+    directory = os.path.join(compiled_path, forest.source_sha256)
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=compiled_path)
+    try:
+        forest.save(staging)
+        os.replace(staging, directory)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, META_FILE)):
+            raise
+    return directory
+
+
+def load_forest(model_path, compiled_path, mmap_mode=None):
+    # Prefer the compiled arrays of this exact model file; only unpickle the
+    # sklearn model (and import sklearn) when they have not been built yet.
+    directory = os.path.join(compiled_path, file_sha256(model_path))
+    if os.path.exists(os.path.join(directory, META_FILE)):
+        return CompiledForest.load(directory, mmap_mode=mmap_mode)
+    import joblib
+    # Hash the bytes that are unpickled, the file may be replaced meanwhile
+    with open(model_path, "rb") as f:
+        data = f.read()
+    forest = compile_forest(joblib.load(io.BytesIO(data)), source_sha256=hashlib.sha256(data).hexdigest())
+    try:
+        directory = publish_forest(forest, compiled_path)
+    except OSError:
+        return forest
+    return CompiledForest.load(directory, mmap_mode=mmap_mode)
+
+
+def check_forest(rf_model, forest, X):
+    # Rows of X whose predict_proba or predict differ from the sklearn model's
+    import pandas as pd
+    X = np.asarray(X, dtype=np.float32)
+    if forest.feature_names:
+        # A model fitted on a DataFrame warns when given a bare array
+        X_sklearn = pd.DataFrame(X, columns=forest.feature_names)
+    else:
+        X_sklearn = X
+    proba_mismatch = (forest.predict_proba(X) != rf_model.predict_proba(X_sklearn)).any(axis=1)
+    predict_mismatch = forest.predict(X) != rf_model.predict(X_sklearn)
+    return np.flatnonzero(proba_mismatch | predict_mismatch)
+
+
+if __name__ == "__main__":
+    # python compiled_forest.py            compile and publish MDMP_model.joblib
+    # python compiled_forest.py --check [seed]
+    #   compare the published copy and a fresh compile bit for bit with the
+    #   sklearn model on the dataset and on random feature vectors
+    import sys
+    import joblib
+    import pandas as pd
+    model_file = "MDMP_model.joblib"
+    output_dir = "MDMP_model_compiled"
+    rf_model = joblib.load(model_file)
+    compiled = compile_forest(rf_model, source_sha256=file_sha256(model_file))
+    if "--check" not in sys.argv:
+        directory = publish_forest(compiled, output_dir)
+        print(f"Compiled {compiled.n_estimators} trees ({len(compiled.feature)} nodes) into {directory}")
+        sys.exit(0)
+    seeds = [arg for arg in sys.argv[1:] if arg != "--check"]
+    rng = np.random.default_rng(int(seeds[0]) if seeds else 0)
+    dataset = pd.read_csv("dataset_with_all_category_scores.csv")
+    if "Total_Score" not in dataset.columns:
+        dataset["Total_Score"] = dataset[[column for column in dataset.columns if column.endswith("_Score")]].sum(axis=1)
+    X_dataset = dataset[compiled.feature_names].to_numpy(dtype=np.float32)
+    # Random vectors: each feature drawn from a range around the dataset's,
+    # from the dataset's own values or from the forest's split thresholds
+    # (rows landing exactly on a split exercise the <= comparison)
+    n_generated = 20000
+    low, high = X_dataset.min(axis=0), X_dataset.max(axis=0)
+    span = np.maximum(high - low, 1.0)
+    X_generated = np.empty((n_generated, compiled.n_features), dtype=np.float32)
+    for index in range(compiled.n_features):
+        thresholds = compiled.threshold[(compiled.feature == index) & (compiled.left != np.arange(len(compiled.feature)))]
+        candidates = [
+            rng.uniform(low[index] - span[index], high[index] + span[index], n_generated),
+            rng.choice(X_dataset[:, index], n_generated),
+        ]
+        if len(thresholds):
+            candidates.append(rng.choice(thresholds, n_generated))
+        source = rng.integers(len(candidates), size=n_generated)
+        X_generated[:, index] = np.choose(source, candidates)
+    forests = [("compiled", compiled), ("published", load_forest(model_file, output_dir, mmap_mode="r"))]
+    failed = False
+    for name, X in [("dataset", X_dataset), ("generated", X_generated)]:
+        for forest_name, forest in forests:
+            mismatches = check_forest(rf_model, forest, X)
+            print(f"{name} ({forest_name}): {len(X)} rows, {len(mismatches)} mismatches")
+            failed = failed or len(mismatches) > 0
+    if failed:
+        sys.exit(1)
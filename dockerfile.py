@@ -17,5 +17,7 @@ COPY . /app
 # Expose port 8080 for Cloud Run
 EXPOSE 8080
 
-# Run uvicorn using host 0.0.0.0 and port 8080
-CMD ["uvicorn", "api:app", "--host=0.0.0.0", "--port=8080"]
+# Run gunicorn with one uvicorn worker per core, all forked from a master that
+# has already loaded the model (see gunicorn.conf.py). For a single process:
+#   uvicorn api:app --host=0.0.0.0 --port=8080
+CMD ["gunicorn", "api:app", "-c", "gunicorn.conf.py"]
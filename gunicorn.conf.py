@@ -0,0 +1,37 @@
+import gc
+import multiprocessing
+import os
+
+# ---------------------------
+# Production serving: gunicorn master + uvicorn workers
+# ---------------------------
+# gunicorn -c gunicorn.conf.py api:app
+# The master imports the app and loads the model, feature columns and mappings
+# once; workers are forked from it and share those pages copy-on-write (the
+# compiled forest itself is a read-only memory map). Each worker warms up on
+# dataset scenarios in its startup, before it accepts connections, so no
+# request reaches a cold worker (GET /readyz reports the warm-up); workers are
+# recycled after max_requests (+ jitter) requests.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+max_requests = int(os.environ.get("MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", "1000"))
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+# Heartbeat files on tmpfs, containers often have a slow or overlay /tmp
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported, before any worker forks
+    from model_store import registry
+    loaded = registry.get()
+    server.log.info(f"Loaded model version {loaded.version} ({loaded.sha256[:12]}) in the master")
+    # Keep the loaded objects out of the collector's reach so a worker's
+    # garbage collections don't write to (and copy) the shared pages
+    gc.freeze()
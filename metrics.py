@@ -0,0 +1,171 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# ---------------------------
+# Prometheus metrics
+# ---------------------------
+# Counters, gauges and histograms that are cheap enough to leave on under
+# full load. Every thread updates its own shard of a metric (a plain dict
+# only that thread writes), so recording never takes a lock; a lock is only
+# taken the first time a thread touches a metric. A scrape sums the shards
+# and adds whatever the registered collectors report at that moment.
+
+# Seconds; request stages range from microseconds (encoding) to seconds (big batches)
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144)
+
+_metrics = []
+_collectors = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def _merged(self):
+        # label values -> aggregated value, summed over every thread's shard
+        merged = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                merged[labels] = self._add(merged.get(labels), value)
+        return merged
+
+    def _add(self, total, value):
+        return value if total is None else total + value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._merged().items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Counter):
+    # Per-thread deltas, so inc() and dec() may happen on different threads
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket, the +Inf bucket, then the running sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _add(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self):
+        bounds = [format_value(bound) for bound in self.buckets] + ["+Inf"]
+        names = self.labelnames + ("le",)
+        for labels, counts in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts[:-1]):
+                cumulative += count
+                yield self.name + "_bucket", names, labels + (bound,), cumulative
+            yield self.name + "_sum", self.labelnames, labels, counts[-1]
+            yield self.name + "_count", self.labelnames, labels, cumulative
+
+
+def register_collector(collect):
+    # collect() -> iterable of (name, kind, help, [(labels dict, value), ...]), called on every scrape
+    _collectors.append(collect)
+
+
+def format_value(value):
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_sample(name, labelnames, labels, value):
+    if labelnames:
+        pairs = ",".join(f'{label}="{escape(item)}"' for label, item in zip(labelnames, labels))
+        return f"{name}{{{pairs}}} {format_value(value)}"
+    return f"{name} {format_value(value)}"
+
+
+def render():
+    # Prometheus text exposition format (version 0.0.4)
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(format_sample(*sample) for sample in metric.samples())
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(format_sample(name, tuple(labels), tuple(labels.values()), value))
+    return "\n".join(lines) + "\n"
+
+
+# Shared by the API, the micro-batcher and model_logic
+REQUEST_LATENCY = Histogram("mdmp_request_seconds", "Time spent handling a request", ("route", "method"))
+STAGE_LATENCY = Histogram("mdmp_stage_seconds", "Time spent in one stage of scoring a request", ("stage",))
+BATCH_SIZE = Histogram("mdmp_batch_size", "Scenarios scored together", ("source",), buckets=SIZE_BUCKETS)
+IN_FLIGHT = Gauge("mdmp_requests_in_flight", "Requests being handled right now", ("route",))
+REQUESTS = Counter("mdmp_requests_total", "Requests handled, by response status", ("route", "status"))
+ERRORS = Counter("mdmp_errors_total", "Failed requests or scenarios, by error type", ("route", "type"))
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage)
@@ -0,0 +1,138 @@
+import asyncio
+import os
+import time
+from collections import Counter, deque
+import numpy as np
+from metrics import BATCH_SIZE, STAGE_LATENCY
+
+# ---------------------------
+# Micro-batching inference dispatcher
+# ---------------------------
+# Concurrent /predict calls are parked on a future and collected for up to
+# MICRO_BATCH_WAIT_MS (or until MICRO_BATCH_MAX_SIZE are waiting); the whole
+# batch is then scored by one predict_many call on a worker thread while the
+# next batch is being collected.
+
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", "64"))
+MICRO_BATCH_WAIT_MS = float(os.environ.get("MICRO_BATCH_WAIT_MS", "2"))
+# Queue waits kept for the percentiles in stats()
+WAIT_SAMPLES = 4096
+
+
+class MicroBatcher:
+    def __init__(self, predict_many, max_batch_size=MICRO_BATCH_MAX_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS):
+        # predict_many(list of items, version) -> list of results, same order
+        self.predict_many = predict_many
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.loop = None
+        self.task = None
+        self.pending = []
+        self.requests = 0
+        self.batches = 0
+        self.failures = 0
+        self.batch_sizes = Counter()
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.max_wait_seen = 0.0
+
+    def _start(self, loop):
+        # The dispatcher lives on the loop of the first caller (one per worker process)
+        self.loop = loop
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.full = asyncio.Event()
+        self.task = loop.create_task(self._run())
+
+    async def submit(self, item, version):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self._start(loop)
+        future = loop.create_future()
+        self.pending.append((item, version, future, time.perf_counter()))
+        self.arrived.set()
+        if len(self.pending) >= self.max_batch_size:
+            self.full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self.arrived.wait()
+            self.arrived.clear()
+            if not self.pending:
+                continue
+            if len(self.pending) < self.max_batch_size and self.max_wait > 0:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            if self.pending:
+                self.arrived.set()
+            if len(self.pending) >= self.max_batch_size:
+                self.full.set()
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        dispatched = time.perf_counter()
+        for _, _, _, enqueued in batch:
+            wait = dispatched - enqueued
+            self.waits.append(wait)
+            self.max_wait_seen = max(self.max_wait_seen, wait)
+            STAGE_LATENCY.observe(wait, "batch_wait")
+        BATCH_SIZE.observe(len(batch), "micro_batch")
+        self.requests += len(batch)
+        self.batches += 1
+        self.batch_sizes[len(batch)] += 1
+        work = self.loop.run_in_executor(None, self._evaluate, batch)
+        work.add_done_callback(lambda done: self._resolve(batch, done))
+
+    def _evaluate(self, batch):
+        # Group by model version so a pinned request is never scored by another version
+        groups = {}
+        for position, (item, version, _, _) in enumerate(batch):
+            groups.setdefault(id(version), (version, []))[1].append(position)
+        outcomes = [None] * len(batch)
+        for version, positions in groups.values():
+            try:
+                results = self.predict_many([batch[position][0] for position in positions], version)
+                for position, result in zip(positions, results):
+                    outcomes[position] = (True, result)
+            except Exception as e:
+                for position in positions:
+                    outcomes[position] = (False, e)
+        return outcomes
+
+    def _resolve(self, batch, done):
+        if done.exception() is not None:
+            outcomes = [(False, done.exception())] * len(batch)
+        else:
+            outcomes = done.result()
+        for (_, _, future, _), (ok, value) in zip(batch, outcomes):
+            if future.done():
+                # The caller went away (request cancelled)
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                self.failures += 1
+                future.set_exception(value)
+
+    def stats(self):
+        waits = np.array(self.waits) * 1000
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "requests": self.requests,
+            "batches": self.batches,
+            "failures": self.failures,
+            "queued": len(self.pending),
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_size_counts": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "queue_wait_ms": {
+                "p50": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                "p99": float(np.percentile(waits, 99)) if len(waits) else 0.0,
+                "max": self.max_wait_seen * 1000,
+            },
+        }
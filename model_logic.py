@@ -1,51 +1,479 @@
-import joblib
-import pandas as pd
-from mappings_fixed import (
-    Target_Category_Map, Target_Vulnerability_Map, Terrain_Type_Map, 
-    Civilian_Presence_Map, Damage_Assessment_Map, Time_Sensitivity_Map, 
-    Weaponeering_Map, Friendly_Fire_Map, Politically_Sensitive_Map, 
-    Legal_Advice_Map, Ethical_Concerns_Map, Collateral_Damage_Potential_Map, 
-    AI_Distinction_Map, AI_Proportionality_Map, AI_Military_Necessity_Map,
-    Human_Distinction_Map, Human_Proportionality_Map, Human_Military_Necessity_Map
-)
-
-# File paths must match exactly your actual files:
-MODEL_PATH = "MDMP_model.joblib"
-FEATURES_PATH = "MDMP_feature_columns.joblib"
-
-# Load the trained model and feature columns
-model = joblib.load(MODEL_PATH)
-trained_feature_columns = joblib.load(FEATURES_PATH)
+import asyncio
+import csv
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from compiled_forest import top_two_margin, BLOCK_ROWS
+from model_store import MODEL_PATH, FEATURES_PATH, COMPILED_MODEL_PATH, DATASET_PATH, registry, get_model, get_forest, get_feature_columns
+from scenario_encoder import encoder, UNKNOWN_CODE
+from metrics import STAGE_LATENCY
+
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "4096"))
+# Worker processes for forest evaluation; 0 scores in the calling thread
+INFERENCE_PROCESSES = int(os.environ.get("INFERENCE_PROCESSES", "0"))
+# Most chunks queued or running in the pool before callers get InferenceOverloaded;
+# a matrix of more than INFERENCE_QUEUE_SIZE * BLOCK_ROWS rows is InferenceTooLarge
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "256"))
+# Smaller matrices are cheaper to score in place than to ship to a worker
+INFERENCE_MIN_ROWS = int(os.environ.get("INFERENCE_MIN_ROWS", "1"))
+# Dataset scenarios scored by warm_up() before a process reports ready
+WARMUP_PREDICTIONS = int(os.environ.get("WARMUP_PREDICTIONS", "32"))
+
+# Model versions (compiled node arrays plus feature columns) are loaded and
+# hot-swapped by the registry in model_store. `model_logic.model` and
+# `model_logic.trained_feature_columns` still resolve, to the active version,
+# for older callers.
+def __getattr__(name):
+    if name == "model":
+        return get_forest()
+    if name == "trained_feature_columns":
+        return get_feature_columns()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+labels = {0: "Do Not Engage", 1: "Ask Authorization", 2: "Do Not Know", 3: "Engage"}
+
+# ---------------------------
+# Prediction cache
+# ---------------------------
+# The forest only sees the score vector, so every label combination with the
+# same scores shares one entry. Keys also carry the model's sha256, so a
+# retrained or pinned version never sees another version's answers.
+class PredictionCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
+
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE)
+# Explanations are keyed the same way as predictions
+explanation_cache = PredictionCache(PREDICTION_CACHE_SIZE)
+
+def cache_info():
+    return prediction_cache.info()
+
+# ---------------------------
+# Process-pool inference
+# ---------------------------
+# Optional pool of worker processes that each load the model registry once
+# (the compiled arrays are memory-mapped, so the pages are shared) and
+# evaluate the forest off the serving process's GIL. Large matrices are split
+# into BLOCK_ROWS chunks that run on different workers.
+class InferenceRejected(RuntimeError):
+    pass
+
+
+class InferenceOverloaded(InferenceRejected):
+    # The queue is full right now, a retry can succeed
+    pass
+
+
+class InferenceTooLarge(InferenceRejected):
+    # The matrix needs more chunks than the queue can ever hold
+    pass
+
+
+def _init_inference_worker():
+    registry.get()
+
+
+def _score_in_worker(method, version, sha256, X):
+    loaded = get_model(version)
+    if loaded.sha256 != sha256:
+        # The parent has picked up a new file this worker has not seen yet
+        registry.scan()
+        loaded = get_model(version)
+    return getattr(loaded.forest, method)(X)
+
+
+class InferenceExecutor:
+    def __init__(self, processes, queue_size):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.queued = 0
+        self.rejected = 0
+        self.too_large = 0
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_inference_worker,
+        )
+
+    def submit(self, method, loaded, X):
+        # concurrent.futures.Future per chunk. The slots of all chunks are taken
+        # at once, so a request is either queued whole or rejected holding none:
+        # InferenceTooLarge when it could never fit, InferenceOverloaded when
+        # the queue is too full right now.
+        X = np.asarray(X, dtype=np.float32)
+        chunks = [X[start:start + BLOCK_ROWS] for start in range(0, max(len(X), 1), BLOCK_ROWS)]
+        with self.lock:
+            if len(chunks) > self.queue_size:
+                self.too_large += 1
+                raise InferenceTooLarge(
+                    f"{len(X)} rows exceed the inference limit of {self.queue_size * BLOCK_ROWS} rows per request"
+                )
+            if self.queued + len(chunks) > self.queue_size:
+                self.rejected += 1
+                raise InferenceOverloaded(f"Inference queue is full ({self.processes} processes)")
+            self.queued += len(chunks)
+        futures = []
+        try:
+            for chunk in chunks:
+                future = self.pool.submit(_score_in_worker, method, loaded.version, loaded.sha256, chunk)
+                future.add_done_callback(self._release)
+                futures.append(future)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            with self.lock:
+                self.queued -= len(chunks) - len(futures)
+            raise
+        return futures
+
+    def _release(self, _):
+        with self.lock:
+            self.queued -= 1
+
+    def run(self, method, loaded, X):
+        return combine_chunks([future.result() for future in self.submit(method, loaded, X)])
+
+    async def run_async(self, method, loaded, X):
+        futures = [asyncio.wrap_future(future) for future in self.submit(method, loaded, X)]
+        return combine_chunks(await asyncio.gather(*futures))
+
+    def info(self):
+        with self.lock:
+            return {
+                "processes": self.processes, "queue_size": self.queue_size, "max_rows": self.queue_size * BLOCK_ROWS,
+                "queued": self.queued, "rejected": self.rejected, "too_large": self.too_large,
+            }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def combine_chunks(results):
+    # predict_details chunks concatenate both arrays; explain chunks share the bias
+    first, second = zip(*results)
+    if first[0].ndim == 1:
+        return first[0], np.concatenate(second)
+    return np.concatenate(first), np.concatenate(second)
+
+
+inference_executor = None
+_executor_lock = threading.Lock()
+
+def get_inference_executor():
+    # The pool is started on first use, None when INFERENCE_PROCESSES is 0
+    global inference_executor
+    if INFERENCE_PROCESSES <= 0:
+        return None
+    if inference_executor is None:
+        with _executor_lock:
+            if inference_executor is None:
+                inference_executor = InferenceExecutor(INFERENCE_PROCESSES, INFERENCE_QUEUE_SIZE)
+    return inference_executor
+
+def inference_executor_info():
+    executor = inference_executor
+    if executor is None:
+        return {"processes": max(INFERENCE_PROCESSES, 0), "started": False}
+    return dict(executor.info(), started=True)
+
+def shutdown_inference_executor():
+    global inference_executor
+    with _executor_lock:
+        if inference_executor is not None:
+            inference_executor.shutdown()
+            inference_executor = None
+
+def timed_forest(method, loaded, X):
+    started = time.perf_counter()
+    result = getattr(loaded.forest, method)(X)
+    STAGE_LATENCY.observe(time.perf_counter() - started, method)
+    return result
+
+def score_matrix(method, loaded, X):
+    # loaded.forest.<method>(X), on the process pool when one is configured.
+    # Forest time is recorded under the method name ("<method>_pool" on the pool).
+    executor = get_inference_executor()
+    if executor is None or len(X) < max(INFERENCE_MIN_ROWS, 1):
+        return timed_forest(method, loaded, X)
+    started = time.perf_counter()
+    result = executor.run(method, loaded, X)
+    STAGE_LATENCY.observe(time.perf_counter() - started, f"{method}_pool")
+    return result
+
+async def score_matrix_async(method, loaded, X):
+    # Same as score_matrix, awaiting the pool instead of blocking a thread
+    executor = get_inference_executor()
+    if executor is None or len(X) < max(INFERENCE_MIN_ROWS, 1):
+        return await asyncio.get_running_loop().run_in_executor(None, timed_forest, method, loaded, X)
+    started = time.perf_counter()
+    result = await executor.run_async(method, loaded, X)
+    STAGE_LATENCY.observe(time.perf_counter() - started, f"{method}_pool")
+    return result
 
 def convert_raw_to_scores(raw_input):
-    scores = {
-        "Target_Category_Score": Target_Category_Map[raw_input["Target_Category"]],
-        "Target_Vulnerability_Score": Target_Vulnerability_Map[raw_input["Target_Vulnerability"]],
-        "Terrain_Type_Score": Terrain_Type_Map[raw_input["Terrain_Type"]],
-        "Civilian_Presence_Score": Civilian_Presence_Map[raw_input["Civilian_Presence"]],
-        "Damage_Assessment_Score": Damage_Assessment_Map[raw_input["Damage_Assessment"]],
-        "Time_Sensitivity_Score": Time_Sensitivity_Map[raw_input["Time_Sensitivity"]],
-        "Weaponeering_Score": Weaponeering_Map[raw_input["Weaponeering"]],
-        "Friendly_Fire_Score": Friendly_Fire_Map[raw_input["Friendly_Fire"]],
-        "Politically_Sensitive_Score": Politically_Sensitive_Map[raw_input["Politically_Sensitive"]],
-        "Legal_Advice_Score": Legal_Advice_Map[raw_input["Legal_Advice"]],
-        "Ethical_Concerns_Score": Ethical_Concerns_Map[raw_input["Ethical_Concerns"]],
-        "Collateral_Damage_Potential_Score": Collateral_Damage_Potential_Map[raw_input["Collateral_Damage_Potential"]],
-        "AI_Distinction (%)_Score": AI_Distinction_Map[raw_input["AI_Distinction (%)"]],
-        "AI_Proportionality (%)_Score": AI_Proportionality_Map[raw_input["AI_Proportionality (%)"]],
-        "AI_Military_Necessity_Score": AI_Military_Necessity_Map[raw_input["AI_Military_Necessity"]],
-        "Human_Distinction (%)_Score": Human_Distinction_Map[raw_input["Human_Distinction (%)"]],
-        "Human_Proportionality (%)_Score": Human_Proportionality_Map[raw_input["Human_Proportionality (%)"]],
-        "Human_Military_Necessity_Score": Human_Military_Necessity_Map[raw_input["Human_Military_Necessity"]],
-    }
-    scores["Total_Score"] = sum(scores.values())
-    return scores
+    # Score dict keyed by "*_Score" column plus Total_Score, see scenario_encoder.py
+    return dict(zip(encoder.score_columns, encoder.scenario_scores(raw_input).tolist()))
+
+def class_labels(version=None):
+    return [labels[code] for code in get_model(version).forest.classes]
 
-def predict_scenario(numeric_data):
-    input_df = pd.DataFrame([numeric_data], columns=trained_feature_columns)
-    prediction_code = model.predict(input_df)[0]
-    labels = {0: "Do Not Engage", 1: "Ask Authorization", 2: "Do Not Know", 3: "Engage"}
+def build_result(loaded, prediction_code, probabilities, votes):
+    class_names = [labels[code] for code in loaded.forest.classes]
+    top_two = sorted(probabilities)[-2:]
     return {
         "prediction_code": int(prediction_code),
-        "prediction_label": labels[prediction_code]
+        "prediction_label": labels[prediction_code],
+        "probabilities": dict(zip(class_names, probabilities)),
+        "votes": dict(zip(class_names, votes)),
+        "margin": top_two[1] - top_two[0],
+        "model_version": loaded.version,
+    }
+
+# ---------------------------
+# Feature rows
+# ---------------------------
+# The forest takes float32 rows in the order of the version's feature_columns
+# (MDMP_feature_columns.joblib). Encoded score vectors are put in that order
+# with loaded.feature_index, computed once per version, and score dicts are
+# copied straight into a (preallocated) row; no DataFrame is built on the
+# serving path.
+def features_from_scores(scores, version=None, out=None):
+    # Encoder score vector(s), encoder.score_columns order -> float32 feature row(s)
+    loaded = get_model(version)
+    scores = np.asarray(scores)
+    if out is None:
+        return scores.take(loaded.feature_index, axis=-1).astype(np.float32)
+    out[...] = scores[..., loaded.feature_index]
+    return out
+
+def features_from_mapping(numeric_data, version=None, out=None):
+    # Score dict (or any mapping keyed by feature column) -> float32 feature row
+    loaded = get_model(version)
+    if out is None:
+        out = np.empty(len(loaded.feature_columns), dtype=np.float32)
+    for index, column in enumerate(loaded.feature_columns):
+        out[index] = numeric_data[column]
+    return out
+
+def predict_features(X, version=None):
+    # Float32 feature row or matrix -> batch_result columns, one forest call
+    loaded = get_model(version)
+    return batch_result(loaded, *score_matrix("predict_details", loaded, X))
+
+def row_cache_key(loaded, row):
+    return (loaded.sha256,) + tuple(row.tolist())
+
+def predict_scenario(numeric_data, version=None):
+    # version pins a registry version; None uses the active one
+    loaded = get_model(version)
+    X = features_from_mapping(numeric_data, loaded)[np.newaxis, :]
+    cache_key = row_cache_key(loaded, X[0])
+    cached = prediction_cache.get(cache_key)
+    if cached is None:
+        proba, votes = score_matrix("predict_details", loaded, X)
+        prediction_code = int(loaded.forest.classes[np.argmax(proba[0])])
+        cached = (prediction_code, tuple(proba[0].tolist()), tuple(votes[0].tolist()))
+        prediction_cache.put(cache_key, cached)
+    return build_result(loaded, *cached)
+
+def predict_rows(numeric_rows, version=None):
+    # predict_scenario for a list of score dicts: cached rows come from the
+    # cache, all the others are scored together in one forest call
+    loaded = get_model(version)
+    model = loaded.forest
+    numeric_rows = list(numeric_rows)
+    rows = np.empty((len(numeric_rows), len(loaded.feature_columns)), dtype=np.float32)
+    for row, numeric_data in zip(rows, numeric_rows):
+        features_from_mapping(numeric_data, loaded, out=row)
+    keys = [row_cache_key(loaded, row) for row in rows]
+    results = [prediction_cache.get(cache_key) for cache_key in keys]
+    missing = [position for position, cached in enumerate(results) if cached is None]
+    if missing:
+        X = rows[missing]
+        proba, votes = score_matrix("predict_details", loaded, X)
+        prediction_codes = model.classes.take(np.argmax(proba, axis=1))
+        for row, position in enumerate(missing):
+            cached = (int(prediction_codes[row]), tuple(proba[row].tolist()), tuple(votes[row].tolist()))
+            prediction_cache.put(keys[position], cached)
+            results[position] = cached
+    return [build_result(loaded, *cached) for cached in results]
+
+def warmup_scenarios(count):
+    # Up to `count` raw scenarios spread evenly over the study dataset (labels
+    # stripped, the CSV spells some with a leading space). Falls back to the
+    # first label of every mapping when the dataset is not there.
+    try:
+        with open(DATASET_PATH, newline="") as f:
+            rows = list(csv.DictReader(f))
+    except OSError:
+        rows = []
+    if not rows:
+        return [{feature.column: feature.labels[0] for feature in encoder.features}]
+    step = max(len(rows) // max(count, 1), 1)
+    return [{column: row[column].strip() for column in encoder.columns} for row in rows[::step][:max(count, 1)]]
+
+def warm_up(version=None, count=WARMUP_PREDICTIONS):
+    # Score representative scenarios through the single (micro-batched), batch
+    # and explain paths so a fresh process has done its lazy imports and
+    # allocations and touched the model pages before serving.
+    # Returns {"seconds", "predictions", "model_version"}.
+    started = time.perf_counter()
+    loaded = get_model(version)
+    raw_inputs = warmup_scenarios(count)
+    for raw_input in raw_inputs:
+        predict_rows([convert_raw_to_scores(raw_input)], loaded)
+    scores, _ = encode_raw_batch(raw_inputs)
+    predict_batch(scores, version=loaded)
+    explain_scenario(convert_raw_to_scores(raw_inputs[0]), version=loaded)
+    return {
+        "seconds": time.perf_counter() - started,
+        "predictions": len(raw_inputs),
+        "model_version": loaded.version,
     }
+
+def encode_raw_batch(raw_inputs):
+    # Encode a whole list of raw scenarios column by column instead of row by row.
+    # Returns the score matrix (encoder.score_columns order) for the rows that
+    # encoded cleanly and a {row position: error message} dict for the ones
+    # that did not.
+    raw_inputs = list(raw_inputs)
+    codes = encoder.encode_columns({
+        column: [raw_input.get(column) for raw_input in raw_inputs] for column in encoder.columns
+    })
+    errors = {}
+    for position, feature_index in zip(*np.nonzero(codes == UNKNOWN_CODE)):
+        column = encoder.columns[feature_index]
+        errors.setdefault(int(position), f"Unknown {column} value: {raw_inputs[position].get(column)!r}")
+    valid = np.ones(len(raw_inputs), dtype=bool)
+    valid[list(errors)] = False
+    return encoder.scores_from_codes(codes[valid]), errors
+
+def convert_raw_batch_to_scores(raw_inputs):
+    # encode_raw_batch with the scores as a DataFrame keyed by score column
+    import pandas as pd
+    scores, errors = encode_raw_batch(raw_inputs)
+    return pd.DataFrame(scores, columns=encoder.score_columns), errors
+
+def batch_matrix(loaded, scores):
+    # Score matrix from encode_raw_batch (or a frame with the feature columns) -> float32 features
+    if hasattr(scores, "columns"):
+        return scores[loaded.feature_columns].to_numpy(dtype=np.float32)
+    return features_from_scores(scores, loaded)
+
+def batch_result(loaded, proba, votes):
+    # Results are column arrays, one row per scored scenario;
+    # probabilities/votes columns follow class_labels().
+    prediction_codes = loaded.forest.classes.take(np.argmax(proba, axis=1))
+    return {
+        "prediction_code": prediction_codes,
+        "prediction_label": [labels[code] for code in prediction_codes],
+        "probabilities": proba,
+        "votes": votes,
+        "margin": top_two_margin(proba),
+        "model_version": loaded.version,
+    }
+
+def predict_batch(scores, version=None):
+    # One forest call for the whole matrix
+    loaded = get_model(version)
+    return predict_features(batch_matrix(loaded, scores), loaded)
+
+async def predict_batch_async(scores, version=None):
+    loaded = get_model(version)
+    return batch_result(loaded, *await score_matrix_async("predict_details", loaded, batch_matrix(loaded, scores)))
+
+# ---------------------------
+# Feature contributions
+# ---------------------------
+# Tree-path attribution from CompiledForest.explain: for every class, the
+# forest's base rate plus one contribution per feature adds up to the
+# predicted probability.
+def explain_scenario(numeric_data, version=None):
+    loaded = get_model(version)
+    model = loaded.forest
+    trained_feature_columns = loaded.feature_columns
+    X = features_from_mapping(numeric_data, loaded)[np.newaxis, :]
+    cache_key = row_cache_key(loaded, X[0])
+    cached = explanation_cache.get(cache_key)
+    if cached is None:
+        bias, contributions = score_matrix("explain", loaded, X)
+        cached = (tuple(bias.tolist()), tuple(map(tuple, contributions[0].tolist())))
+        explanation_cache.put(cache_key, cached)
+    bias, contributions = cached
+    prediction = predict_scenario(numeric_data, version=loaded)
+    class_names = [labels[code] for code in model.classes]
+    return {
+        "prediction_code": prediction["prediction_code"],
+        "prediction_label": prediction["prediction_label"],
+        "probabilities": prediction["probabilities"],
+        "bias": dict(zip(class_names, bias)),
+        "contributions": {
+            column: dict(zip(class_names, values)) for column, values in zip(trained_feature_columns, contributions)
+        },
+        "model_version": loaded.version,
+    }
+
+def explanation_result(loaded, bias, contributions):
+    # Contributions are (n_rows, n_features, n_classes), features in
+    # feature_columns order, classes in class_labels() order.
+    return {
+        "bias": bias,
+        "contributions": contributions,
+        "feature_columns": list(loaded.feature_columns),
+        "model_version": loaded.version,
+    }
+
+def explain_batch(scores, version=None):
+    # Contributions for every row in one pass
+    loaded = get_model(version)
+    return explanation_result(loaded, *score_matrix("explain", loaded, batch_matrix(loaded, scores)))
+
+async def explain_batch_async(scores, version=None):
+    loaded = get_model(version)
+    return explanation_result(loaded, *await score_matrix_async("explain", loaded, batch_matrix(loaded, scores)))
@@ -0,0 +1,234 @@
+import glob
+import logging
+import os
+import threading
+import time
+import joblib
+import numpy as np
+from compiled_forest import load_forest
+from scenario_encoder import encoder
+
+# ---------------------------
+# Versioned, hot-reloadable model registry
+# ---------------------------
+# Every MDMP_model*.joblib in MODELS_DIR is a model version:
+#   MDMP_model.joblib       -> version "default"
+#   MDMP_model-<tag>.joblib -> version "<tag>", with MDMP_feature_columns-<tag>.joblib
+#                              when present, otherwise the default feature columns
+# Each version is loaded once per process from its compiled, memory-mapped node
+# arrays (see compiled_forest.py), checked against its feature columns and warmed
+# up. The newest file is the active version unless MODEL_VERSION pins one.
+# Requests keep the version object they started with, so swapping in a new
+# version never disturbs predictions already in flight.
+
+# File paths must match exactly your actual files:
+MODELS_DIR = os.environ.get("MODELS_DIR", ".")
+MODEL_PATH = os.path.join(MODELS_DIR, "MDMP_model.joblib")
+FEATURES_PATH = os.path.join(MODELS_DIR, "MDMP_feature_columns.joblib")
+COMPILED_MODEL_PATH = os.path.join(MODELS_DIR, "MDMP_model_compiled")
+DATASET_PATH = "dataset_with_all_category_scores.csv"
+DEFAULT_VERSION = "default"
+# Seconds between checks of MODELS_DIR for new or changed model files
+RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", "5"))
+WARMUP_ROWS = 64
+
+
+class ModelVersion:
+    def __init__(self, version, model_path, forest, feature_columns, signature):
+        self.version = version
+        self.model_path = model_path
+        self.forest = forest
+        self.feature_columns = feature_columns
+        self.signature = signature
+        # Position of every feature column in encoder.score_columns: one take
+        # puts an encoded score vector in this version's feature order
+        missing = [column for column in feature_columns if column not in encoder.score_columns]
+        if missing:
+            raise ValueError(f"Feature columns {missing} are not produced by the scenario encoder")
+        self.feature_index = np.array([encoder.score_columns.index(column) for column in feature_columns], dtype=np.intp)
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+        self.warmup_seconds = 0.0
+
+    @property
+    def sha256(self):
+        return self.forest.source_sha256
+
+    def info(self):
+        return {
+            "version": self.version,
+            "sha256": self.sha256,
+            "model_path": self.model_path,
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+        }
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def version_paths(model_path):
+    # (version, feature columns path, compiled directory) for one model file
+    name = os.path.basename(model_path)[:-len(".joblib")]
+    if name == "MDMP_model":
+        return DEFAULT_VERSION, FEATURES_PATH, COMPILED_MODEL_PATH
+    tag = name[len("MDMP_model-"):]
+    features_path = os.path.join(MODELS_DIR, f"MDMP_feature_columns-{tag}.joblib")
+    if not os.path.exists(features_path):
+        features_path = FEATURES_PATH
+    return tag, features_path, os.path.join(MODELS_DIR, f"{name}_compiled")
+
+
+def load_version(model_path, signature):
+    version, features_path, compiled_path = version_paths(model_path)
+    started = time.perf_counter()
+    forest = load_forest(model_path, compiled_path, mmap_mode="r")
+    feature_columns = list(joblib.load(features_path))
+    if len(feature_columns) != forest.n_features:
+        raise ValueError(f"{model_path} expects {forest.n_features} features, {features_path} lists {len(feature_columns)}")
+    if forest.feature_names is not None and forest.feature_names != feature_columns:
+        raise ValueError(f"{model_path} was fitted on different columns than {features_path}")
+    loaded = ModelVersion(version, model_path, forest, feature_columns, signature)
+    loaded.load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    forest.predict_details(np.zeros((WARMUP_ROWS, forest.n_features), dtype=np.float32))
+    loaded.warmup_seconds = time.perf_counter() - started
+    return loaded
+
+
+class ModelRegistry:
+    def __init__(self, pinned_version=None):
+        self.pinned_version = pinned_version
+        # (versions by name, active version) is replaced as a whole on every swap
+        self._state = ({}, None)
+        self._scan_lock = threading.Lock()
+        self._last_scan = 0.0
+        # model path -> signature of a file that failed to load, not retried until it changes
+        self._failed = {}
+
+    def scan(self):
+        # Load new or changed model files and swap the active version
+        with self._scan_lock:
+            versions, active = self._state
+            updated = {}
+            for model_path in sorted(glob.glob(os.path.join(MODELS_DIR, "MDMP_model*.joblib"))):
+                signature = file_signature(model_path)
+                if signature is None:
+                    continue
+                version = version_paths(model_path)[0]
+                current = versions.get(version)
+                if (current is not None and current.signature == signature) or self._failed.get(model_path) == signature:
+                    if current is not None:
+                        updated[version] = current
+                    continue
+                try:
+                    updated[version] = load_version(model_path, signature)
+                    self._failed.pop(model_path, None)
+                    logging.info(f"Loaded model version {version} from {model_path}")
+                except Exception as e:
+                    self._failed[model_path] = signature
+                    logging.error(f"Could not load model version {version} from {model_path}: {e}")
+                    if current is not None:
+                        updated[version] = current
+            if not updated:
+                raise FileNotFoundError(f"No loadable MDMP_model*.joblib in {MODELS_DIR!r}")
+            if self.pinned_version in updated:
+                new_active = updated[self.pinned_version]
+            else:
+                new_active = max(updated.values(), key=lambda loaded: loaded.signature[0])
+            self._state = (updated, new_active)
+            self._last_scan = time.monotonic()
+            if active is not new_active:
+                logging.info(f"Active model version is now {new_active.version}")
+
+    def _maybe_rescan(self):
+        if self._state[1] is None:
+            self.scan()
+        elif time.monotonic() - self._last_scan >= RELOAD_INTERVAL and not self._scan_lock.locked():
+            # Poll in the background; callers keep using the current version meanwhile
+            self._last_scan = time.monotonic()
+            threading.Thread(target=self._background_scan, daemon=True).start()
+
+    def _background_scan(self):
+        try:
+            self.scan()
+        except Exception as e:
+            logging.error(f"Model registry scan failed: {e}")
+
+    def get(self, version=None):
+        # Active version, or the requested one; KeyError for an unknown version
+        self._maybe_rescan()
+        versions, active = self._state
+        if version is None:
+            return active
+        return versions[version]
+
+    def versions(self):
+        self._maybe_rescan()
+        versions, active = self._state
+        return [dict(loaded.info(), active=loaded is active) for loaded in versions.values()]
+
+
+registry = ModelRegistry(pinned_version=os.environ.get("MODEL_VERSION"))
+
+_lock = threading.Lock()
+# (file signature, DataFrame) of the last dataset read
+_dataset = None
+# (DataFrame, column pairs, ScenarioSampler) of the last sampler built
+_sampler = None
+
+
+def get_model(version=None):
+    # version: a version name, an already resolved ModelVersion, or None for the active one
+    if isinstance(version, ModelVersion):
+        return version
+    return registry.get(version)
+
+
+def get_forest():
+    return registry.get().forest
+
+
+def get_feature_columns():
+    return registry.get().feature_columns
+
+
+def get_dataset():
+    # Scenario dataset for the study app, shared by every session in the
+    # process; treat it as read-only. Re-read when the CSV changes on disk.
+    global _dataset
+    signature = file_signature(DATASET_PATH)
+    cached = _dataset
+    if cached is None or cached[0] != signature:
+        with _lock:
+            if _dataset is None or _dataset[0] != signature:
+                import pandas as pd
+                from civilian_presence import register_labels
+                dataset = pd.read_csv(DATASET_PATH)
+                # Parse the dataset's Civilian_Presence spellings once, up front
+                register_labels(dataset["Civilian_Presence"].unique())
+                _dataset = (signature, dataset)
+            cached = _dataset
+    return cached[1]
+
+
+def get_scenario_sampler(column_pairs):
+    # ScenarioSampler over get_dataset(), shared like the dataset itself: built
+    # once per dataset read, so a draw never pays for the dataset's size
+    global _sampler
+    dataset = get_dataset()
+    column_pairs = tuple(tuple(pair) for pair in column_pairs)
+    cached = _sampler
+    if cached is None or cached[0] is not dataset or cached[1] != column_pairs:
+        with _lock:
+            if _sampler is None or _sampler[0] is not dataset or _sampler[1] != column_pairs:
+                from scenario_sampler import ScenarioSampler
+                _sampler = (dataset, column_pairs, ScenarioSampler(dataset, column_pairs))
+            cached = _sampler
+    return cached[2]
@@ -0,0 +1,215 @@
+import logging
+import numpy as np
+import pandas as pd
+from civilian_presence import civilian_presence_interval
+
+# ---------------------------
+# Legal & ethical override rules
+# ---------------------------
+# apply_override_rules checks one scenario row; apply_override_rules_batch
+# evaluates the same rules as boolean masks over whole columns and gives
+# every row the first rule that matches, in the same priority order.
+# Rows no rule applies to fall back to the Total_Score thresholds of
+# assign_final_decision.
+
+NO_OVERRIDE = "No override rules applied"
+PROTECTED_TARGETS = ["Chapel", "Medical Installation", "Medical Vehicle"]
+POPULATED_TERRAIN = ["Urban Center", "Residential Area"]
+PRIORITY_TARGETS = ["High-Value Target", "Battalion HQ", "Battlegroup HQ", "Brigade HQ", "Division HQ"]
+SPECIAL_WEAPONS = ["Incendiary Weapon", "Thermobaric Munition", "White Phosphorus Bomb"]
+NAVAL_TARGETS = ["Fighter Aircraft", "Frigate", "Ship Maintenance Facility", "Naval Base"]
+TORPEDO_TARGETS = ["Ship Maintenance Facility", "Naval Base", "Frigate"]
+RULE_COLUMNS = [
+    "Target_Category", "Terrain_Type", "Ethical_Concerns", "Civilian_Presence",
+    "Collateral_Damage_Potential", "Friendly_Fire", "Weaponeering", "Legal_Advice",
+    "Politically_Sensitive",
+]
+# (lowest Total_Score, decision), highest threshold first; lower scores are "Do Not Engage"
+DECISION_THRESHOLDS = [(30, "Engage"), (22.5, "Ask Authorization"), (15, "Do Not Know")]
+BELOW_THRESHOLDS = "Do Not Engage"
+
+
+def assign_final_decision(total_score):
+    for threshold, decision in DECISION_THRESHOLDS:
+        if total_score >= threshold:
+            return decision
+    return BELOW_THRESHOLDS
+
+
+def assign_final_decision_batch(total_score):
+    # assign_final_decision over an array of totals
+    total_score = np.asarray(total_score, dtype=float)
+    return np.select(
+        [total_score >= threshold for threshold, _ in DECISION_THRESHOLDS],
+        [decision for _, decision in DECISION_THRESHOLDS],
+        BELOW_THRESHOLDS,
+    ).astype(object)
+
+
+def apply_override_rules(row):
+    try:
+        categories = {col: row[col] for col in row.index if not col.endswith('_Score')}
+        if 'Total_Score' not in row or pd.isna(row['Total_Score']):
+            row['Total_Score'] = row[[col for col in row.index if col.endswith('_Score')]].sum()
+            logging.info("Calculated Total_Score in apply_override_rules")
+        if categories['Target_Category'] in PROTECTED_TARGETS:
+            return "Do Not Engage", f"Protected Target_Category '{categories['Target_Category']}'"
+        if (categories['Terrain_Type'] in POPULATED_TERRAIN) and \
+           (categories['Target_Category'] not in PRIORITY_TARGETS):
+            return "Do Not Engage", f"Non-priority target in {categories['Terrain_Type']}"
+        if categories['Ethical_Concerns'] == 'Immoral' and row['Total_Score'] >= 30:
+            return "Do Not Engage", "Ethical concerns override high score"
+        # Lower bound of the parsed Civilian_Presence interval, None if unparseable
+        presence = civilian_presence_interval(categories['Civilian_Presence'])
+        if presence is None:
+            logging.warning(f"Could not parse Civilian_Presence value: {categories['Civilian_Presence']}")
+        presence_low = None if presence is None else presence[0]
+        if presence_low is not None and presence_low >= 100:
+            return "Do Not Engage", f"High civilian presence: {categories['Civilian_Presence']}"
+        if categories['Collateral_Damage_Potential'] == 'Very_High' and \
+           presence_low is not None and presence_low >= 50:
+            return "Do Not Engage", "High collateral damage risk with significant civilian presence"
+        if categories['Friendly_Fire'] == "Very_High" and categories['Collateral_Damage_Potential'] == 'Very_High':
+            return "Do Not Engage", "Multiple high-risk factors present"
+        if presence_low is not None and presence_low > 30 and categories['Weaponeering'] in SPECIAL_WEAPONS:
+            return "Ask Authorization", "Special weapons with civilian presence > 30"
+        if categories['Legal_Advice'] in ['It depends', 'Questionable'] or \
+           (categories['Ethical_Concerns'] == 'Immoral' and presence_low is not None and presence_low > 50):
+            return "Ask Authorization", "Legal/ethical concerns require authorization"
+        if categories['Politically_Sensitive'] == "High" and categories['Terrain_Type'] == "Critical Infrastructure Area":
+            return "Ask Authorization", "Sensitive infrastructure engagement"
+        if categories['Weaponeering'] == "Anti-Personnel Mine" and \
+           categories['Target_Category'] in NAVAL_TARGETS:
+            return "Do Not Know", "Inappropriate weapon for target type"
+        if categories['Weaponeering'] == "Torpedo" and \
+           categories['Target_Category'] not in TORPEDO_TARGETS:
+            return "Do Not Know", "Torpedo inappropriate for non-naval target"
+        return None, NO_OVERRIDE
+    except KeyError as e:
+        logging.error(f"Missing required column in override rules: {e}")
+        return None, NO_OVERRIDE
+    except Exception as e:
+        logging.error(f"Unexpected error in apply_override_rules: {e}")
+        return None, NO_OVERRIDE
+
+
+class FactorizedColumn:
+    # One column split into integer codes and its distinct values, so every
+    # rule is decided once per distinct value and broadcast with a take.
+    # Missing values (NaN/None) share code -1.
+    def __init__(self, values):
+        self.codes, self.uniques = values.factorize()
+
+    def lookup(self, function, missing, dtype):
+        # function(value) for every row, `missing` where the value is missing
+        table = np.array([function(value) for value in self.uniques] + [missing], dtype=dtype)
+        return table.take(self.codes)
+
+    def mask(self, predicate):
+        return self.lookup(lambda value: bool(predicate(value)), False, bool)
+
+    def isin(self, labels):
+        return self.mask(lambda value: value in labels)
+
+    def equals(self, label):
+        return self.mask(lambda value: value == label)
+
+    def format(self, template, hit):
+        # template.format(value) for the rows in hit
+        table = np.array([template.format(value) for value in self.uniques] + [None], dtype=object)
+        return table.take(self.codes[hit])
+
+
+def apply_override_rules_batch(df):
+    # (decisions, reasons) Series aligned with df; decision None where no rule applies.
+    # Matches apply_override_rules row for row; df must have the RULE_COLUMNS.
+    missing = [col for col in RULE_COLUMNS if col not in df.columns]
+    if missing:
+        raise KeyError(f"Missing required columns for override rules: {missing}")
+    n_rows = len(df)
+    if 'Total_Score' in df.columns:
+        total_score = df['Total_Score'].to_numpy(dtype=float, na_value=np.nan)
+    else:
+        total_score = np.full(n_rows, np.nan)
+    missing_total = np.isnan(total_score)
+    if missing_total.any():
+        score_cols = [col for col in df.columns if col.endswith('_Score')]
+        total_score[missing_total] = df.loc[missing_total, score_cols].sum(axis=1).to_numpy(dtype=float)
+
+    column = {col: FactorizedColumn(df[col]) for col in RULE_COLUMNS}
+    presence = column['Civilian_Presence']
+    presence_valid = presence.mask(lambda value: civilian_presence_interval(value) is not None)
+    presence_low = presence.lookup(lambda value: (civilian_presence_interval(value) or (0, None))[0], 0, np.int64)
+    if not presence_valid.all():
+        logging.warning(f"Could not parse Civilian_Presence for {int((~presence_valid).sum())} rows")
+    immoral = column['Ethical_Concerns'].equals('Immoral')
+    collateral_very_high = column['Collateral_Damage_Potential'].equals('Very_High')
+
+    def labelled(template, col):
+        return lambda hit: column[col].format(template, hit)
+
+    # (mask, decision, reason or hit -> reasons), highest priority first
+    rules = [
+        (column['Target_Category'].isin(PROTECTED_TARGETS), "Do Not Engage",
+         labelled("Protected Target_Category '{}'", 'Target_Category')),
+        (column['Terrain_Type'].isin(POPULATED_TERRAIN) & ~column['Target_Category'].isin(PRIORITY_TARGETS),
+         "Do Not Engage", labelled("Non-priority target in {}", 'Terrain_Type')),
+        (immoral & (total_score >= 30), "Do Not Engage", "Ethical concerns override high score"),
+        (presence_valid & (presence_low >= 100), "Do Not Engage",
+         labelled("High civilian presence: {}", 'Civilian_Presence')),
+        (collateral_very_high & presence_valid & (presence_low >= 50),
+         "Do Not Engage", "High collateral damage risk with significant civilian presence"),
+        (column['Friendly_Fire'].equals('Very_High') & collateral_very_high, "Do Not Engage",
+         "Multiple high-risk factors present"),
+        (presence_valid & (presence_low > 30) & column['Weaponeering'].isin(SPECIAL_WEAPONS), "Ask Authorization",
+         "Special weapons with civilian presence > 30"),
+        (column['Legal_Advice'].isin(['It depends', 'Questionable']) | (immoral & presence_valid & (presence_low > 50)),
+         "Ask Authorization", "Legal/ethical concerns require authorization"),
+        (column['Politically_Sensitive'].equals('High') & column['Terrain_Type'].equals('Critical Infrastructure Area'),
+         "Ask Authorization", "Sensitive infrastructure engagement"),
+        (column['Weaponeering'].equals('Anti-Personnel Mine') & column['Target_Category'].isin(NAVAL_TARGETS),
+         "Do Not Know", "Inappropriate weapon for target type"),
+        (column['Weaponeering'].equals('Torpedo') & ~column['Target_Category'].isin(TORPEDO_TARGETS),
+         "Do Not Know", "Torpedo inappropriate for non-naval target"),
+    ]
+    decisions = np.full(n_rows, None, dtype=object)
+    reasons = np.full(n_rows, NO_OVERRIDE, dtype=object)
+    pending = np.ones(n_rows, dtype=bool)
+    for mask, decision, reason in rules:
+        hit = pending & mask
+        if hit.any():
+            decisions[hit] = decision
+            reasons[hit] = reason(hit) if callable(reason) else reason
+            pending &= ~hit
+    return pd.Series(decisions, index=df.index, dtype=object), pd.Series(reasons, index=df.index, dtype=object)
+
+
+if __name__ == "__main__":
+    # Regression check: the batch engine must agree with apply_override_rules on
+    # the dataset and on scenarios drawn independently per column.
+    import sys
+    logging.disable(logging.CRITICAL)
+    dataset = pd.read_csv("dataset_with_all_category_scores.csv")
+    rng = np.random.default_rng(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    n_generated = 20000
+    generated = pd.DataFrame({
+        col: rng.choice(dataset[col].to_numpy(dtype=object), n_generated) for col in dataset.columns
+    })
+    # Exercise the Civilian_Presence parsing edge cases and missing totals too
+    edge_presence = np.array(['0', ' 1-10', ' 50-99', '100-200', '150', '>100', '100+', 'unknown', None, np.nan, 120, 55.0], dtype=object)
+    generated['Civilian_Presence'] = np.where(
+        rng.random(n_generated) < 0.3, rng.choice(edge_presence, n_generated), generated['Civilian_Presence'].to_numpy(dtype=object)
+    )
+    generated['Ethical_Concerns'] = np.where(rng.random(n_generated) < 0.3, 'Immoral', generated['Ethical_Concerns'])
+    score_cols = [col for col in dataset.columns if col.endswith('_Score')]
+    generated['Total_Score'] = generated[score_cols].sum(axis=1).where(rng.random(n_generated) < 0.5)
+    for name, frame in [("dataset", dataset), ("generated", generated)]:
+        decisions, reasons = apply_override_rules_batch(frame)
+        expected = [apply_override_rules(row.copy()) for _, row in frame.iterrows()]
+        mismatches = [
+            position for position, (decision, reason) in enumerate(expected)
+            if decisions.iloc[position] != decision or reasons.iloc[position] != reason
+        ]
+        print(f"{name}: {len(frame)} rows, {len(mismatches)} mismatches")
+        if mismatches:
+            sys.exit(1)
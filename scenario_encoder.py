@@ -0,0 +1,134 @@
+from itertools import repeat
+import numpy as np
+from mappings_fixed import (
+    Target_Category_Map, Target_Vulnerability_Map, Terrain_Type_Map,
+    Civilian_Presence_Map, Damage_Assessment_Map, Time_Sensitivity_Map,
+    Weaponeering_Map, Friendly_Fire_Map, Politically_Sensitive_Map,
+    Legal_Advice_Map, Ethical_Concerns_Map, Collateral_Damage_Potential_Map,
+    AI_Distinction_Map, AI_Proportionality_Map, AI_Military_Necessity_Map,
+    Human_Distinction_Map, Human_Proportionality_Map, Human_Military_Necessity_Map
+)
+
+# ---------------------------
+# Integer-coded scenario encoder
+# ---------------------------
+# Every label of every *_Map gets an integer code (its position in the map),
+# and each feature keeps a NumPy array of scores indexed by that code, so
+# encoding is a code lookup followed by np.take.
+
+# Raw input column -> mapping, in the same order as the "*_Score" features
+FEATURE_MAPS = [
+    ("Target_Category", Target_Category_Map),
+    ("Target_Vulnerability", Target_Vulnerability_Map),
+    ("Terrain_Type", Terrain_Type_Map),
+    ("Civilian_Presence", Civilian_Presence_Map),
+    ("Damage_Assessment", Damage_Assessment_Map),
+    ("Time_Sensitivity", Time_Sensitivity_Map),
+    ("Weaponeering", Weaponeering_Map),
+    ("Friendly_Fire", Friendly_Fire_Map),
+    ("Politically_Sensitive", Politically_Sensitive_Map),
+    ("Legal_Advice", Legal_Advice_Map),
+    ("Ethical_Concerns", Ethical_Concerns_Map),
+    ("Collateral_Damage_Potential", Collateral_Damage_Potential_Map),
+    ("AI_Distinction (%)", AI_Distinction_Map),
+    ("AI_Proportionality (%)", AI_Proportionality_Map),
+    ("AI_Military_Necessity", AI_Military_Necessity_Map),
+    ("Human_Distinction (%)", Human_Distinction_Map),
+    ("Human_Proportionality (%)", Human_Proportionality_Map),
+    ("Human_Military_Necessity", Human_Military_Necessity_Map),
+]
+
+UNKNOWN_CODE = -1
+# Label counts and scores are small, int16 keeps million-row code/score matrices compact
+CODE_DTYPE = np.int16
+
+
+class FeatureCodes:
+    def __init__(self, column, mapping):
+        self.column = column
+        self.score_column = f"{column}_Score"
+        self.labels = list(mapping)
+        self.codes = {label: code for code, label in enumerate(self.labels)}
+        self.scores = np.array([mapping[label] for label in self.labels], dtype=CODE_DTYPE)
+
+    def encode_labels(self, values):
+        # Label column -> code array, UNKNOWN_CODE where the label is not in the map.
+        # pandas columns are factorized first so only their (few) distinct
+        # values are looked up; plain sequences go through the dict directly.
+        if hasattr(values, "cat"):
+            values = values.cat
+        if hasattr(values, "categories"):
+            value_codes, uniques = values.codes, values.categories
+        elif hasattr(values, "factorize"):
+            value_codes, uniques = values.factorize()
+        else:
+            values = list(values)
+            return np.fromiter(map(self.codes.get, values, repeat(UNKNOWN_CODE)), dtype=CODE_DTYPE, count=len(values))
+        # Missing values have code -1, which picks the trailing UNKNOWN_CODE
+        remap = np.array([self.codes.get(str(value), UNKNOWN_CODE) for value in uniques] + [UNKNOWN_CODE], dtype=CODE_DTYPE)
+        return np.take(remap, np.asarray(value_codes))
+
+
+class ScenarioEncoder:
+    def __init__(self, feature_maps):
+        self.features = [FeatureCodes(column, mapping) for column, mapping in feature_maps]
+        self.columns = [feature.column for feature in self.features]
+        self.score_columns = [feature.score_column for feature in self.features] + ["Total_Score"]
+        # All score tables back to back; code + offset indexes a feature's slice
+        self.offsets = np.cumsum([0] + [len(feature.labels) for feature in self.features[:-1]]).astype(CODE_DTYPE)
+        self.flat_scores = np.concatenate([feature.scores for feature in self.features])
+
+    def encode_scenario(self, raw_input):
+        # One scenario dict -> code vector; raises KeyError on an unknown label
+        return np.array([feature.codes[raw_input[feature.column]] for feature in self.features], dtype=CODE_DTYPE)
+
+    def scores_from_codes(self, codes):
+        # (n_rows, n_features) or (n_features,) codes -> scores with Total_Score appended
+        codes = np.asarray(codes, dtype=CODE_DTYPE)
+        if codes.ndim == 1:
+            scores = np.take(self.flat_scores, codes + self.offsets)
+            return np.append(scores, scores.sum(dtype=CODE_DTYPE))
+        return self.scores_from_code_columns(codes.T)
+
+    def scores_from_code_columns(self, columns):
+        # One code array per feature, any integer dtype (e.g. zero-copy views of
+        # a request body) -> (n_rows, n_features + 1) scores with Total_Score.
+        # Filled feature-major: one small-table take and one contiguous row per
+        # feature; the result is a transposed view.
+        n_rows = len(columns[0]) if len(columns) else 0
+        scores = np.empty((len(self.features) + 1, n_rows), dtype=CODE_DTYPE)
+        for index, (feature, column) in enumerate(zip(self.features, columns)):
+            if column.dtype == np.uint64:
+                # take() won't cast uint64 indices; valid codes are tiny anyway
+                column = column.astype(np.intp)
+            np.take(feature.scores, column, out=scores[index])
+        scores[:-1].sum(axis=0, dtype=CODE_DTYPE, out=scores[-1])
+        return scores.T
+
+    def invalid_codes(self, columns, limit=20):
+        # (row, feature index, code) of up to `limit` codes outside their mapping
+        found = []
+        for index, (feature, column) in enumerate(zip(self.features, columns)):
+            rows = np.flatnonzero((column < 0) | (column >= len(feature.labels)))
+            found.extend((int(row), index, int(column[row])) for row in rows[:limit])
+        return sorted(found)[:limit]
+
+    def scenario_scores(self, raw_input):
+        return self.scores_from_codes(self.encode_scenario(raw_input))
+
+    def encode_columns(self, raw_columns):
+        # {column: label sequence} (a dict of lists or a DataFrame) -> (n_rows, n_features) codes,
+        # stored feature-major so every per-feature pass reads one contiguous row
+        return np.stack([feature.encode_labels(raw_columns[feature.column]) for feature in self.features]).T
+
+    def encode_frame(self, raw_columns):
+        # Label columns -> (scores with Total_Score, invalid row mask).
+        # Rows with an unknown label are zeroed; callers drop or report them.
+        codes = self.encode_columns(raw_columns)
+        invalid = (codes == UNKNOWN_CODE).any(axis=1)
+        scores = self.scores_from_codes(codes)
+        scores[invalid] = 0
+        return scores, invalid
+
+
+encoder = ScenarioEncoder(FEATURE_MAPS)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# ---------------------------
+# Per-parameter scenario sampler
+# ---------------------------
+# A study scenario pairs every parameter's (label, score) with those of other,
+# independently chosen dataset rows. Shuffling each column pair of the whole
+# dataset and keeping one row draws exactly that: one uniformly random row per
+# parameter, independent across parameters. ScenarioSampler keeps each pair's
+# labels and scores as arrays and draws those row indices directly, so a
+# scenario costs O(parameters) however large the dataset is. Columns that are
+# not parameters come from one more random row, as they would from the
+# shuffled frame.
+
+
+class ScenarioSampler:
+    def __init__(self, dataset, column_pairs, seed=None):
+        # column_pairs: [[label column, score column], ...] (app_main.columns_to_shuffle)
+        self.dataset = dataset
+        self.n_rows = len(dataset)
+        if not self.n_rows:
+            raise ValueError("Cannot sample scenarios from an empty dataset")
+        paired = {column for pair in column_pairs for column in pair}
+        self.pairs = [
+            (label_column, score_column, dataset[label_column].to_numpy(), dataset[score_column].to_numpy())
+            for label_column, score_column in column_pairs
+        ]
+        self.score_columns = [score_column for _, score_column in column_pairs]
+        self.other_columns = [
+            (column, dataset[column].to_numpy())
+            for column in dataset.columns if column not in paired and column != "Total_Score"
+        ]
+        self.index = list(dataset.columns) + ([] if "Total_Score" in dataset.columns else ["Total_Score"])
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self):
+        # One scenario as a Series over the dataset's columns plus Total_Score
+        rows = self.rng.integers(self.n_rows, size=len(self.pairs) + 1)
+        values = {}
+        total_score = 0
+        for (label_column, score_column, labels, scores), row in zip(self.pairs, rows):
+            values[label_column] = labels[row]
+            values[score_column] = scores[row]
+            total_score += scores[row]
+        for column, column_values in self.other_columns:
+            values[column] = column_values[rows[-1]]
+        values["Total_Score"] = total_score
+        return pd.Series([values[column] for column in self.index], index=self.index, dtype=object)
+
+
+if __name__ == "__main__":
+    import time
+    from app_main import columns_to_shuffle
+    from model_store import get_dataset
+    dataset = get_dataset()
+    for repeat in (1, 10000):
+        large = pd.concat([dataset] * repeat, ignore_index=True)
+        sampler = ScenarioSampler(large, columns_to_shuffle)
+        started = time.perf_counter()
+        for _ in range(1000):
+            sampler.sample()
+        print(f"{len(large):>9} rows: {(time.perf_counter() - started) * 1000:.3f} us per scenario")
@@ -0,0 +1,134 @@
+import logging
+
+# ---------------------------
+# Study flow state machine
+# ---------------------------
+# The study is a table: which steps each flow visits and in what order, which
+# flow every scenario runs in, what has to be done before a step can be left
+# and which session keys are reset by a transition. transition() is the only
+# code that moves between steps. It works on any mapping (st.session_state
+# in the app) and never reruns the script itself: a caller reruns once when
+# it returns True (on_click callbacks get that rerun from Streamlit).
+
+TOTAL_SCENARIOS = 10
+# Seconds a participant has for the step 4 decision
+DECISION_SECONDS = 300
+
+FLOWS = {
+    "original": (1, 2, 3, 4, 5, 6, 7, 8, 9),
+    # The model decides first; the participant then reviews and decides
+    "reordered": (2, 5, 6, 3, 4, 7, 8, 9),
+}
+# Flow of each scenario, by scenario number
+SCENARIO_FLOWS = {number: "original" if number <= 5 else "reordered" for number in range(1, TOTAL_SCENARIOS + 1)}
+# Steps only shown in the first scenario
+INTRO_STEPS = {1}
+
+# step -> session key that must be truthy before "next" leaves the step
+GUARDS = {
+    2: "scenario_generated",
+    4: "submitted_decision",
+    5: "model_generated",
+    7: "submitted_feedback",
+}
+
+TIMER_RESET = {
+    "timer_active": False,
+    "decision_deadline": None,
+    "time_remaining": DECISION_SECONDS,
+}
+SCENARIO_RESET = {
+    "scenario": None,
+    "user_decision": None,
+    "model_prediction_label": None,
+    "override_reason": None,
+    "confirmation_feedback": None,
+    "feedback_shared": False,
+    "start_time": None,
+    "decision_time": None,
+    "submitted_decision": False,
+    "submitted_feedback": False,
+    "scenario_generated": False,
+    "model_generated": False,
+    "revealed_reasoning": False,
+    "raw_model_prediction": None,
+    "timeout_handled": False,
+    "start": None,
+    **TIMER_RESET,
+}
+# event -> keys reset when that transition happens
+RESETS = {
+    "next": {},
+    # Going back abandons a running decision timer; step 4 starts a new one
+    "back": TIMER_RESET,
+    "new_scenario": SCENARIO_RESET,
+}
+
+
+def apply_reset(state, reset):
+    for key, value in reset.items():
+        state[key] = value
+
+
+def first_step(number):
+    flow = FLOWS[SCENARIO_FLOWS[number]]
+    steps = flow if number == 1 else [step for step in flow if step not in INTRO_STEPS]
+    return steps[0]
+
+
+def start_scenario(state, number):
+    # Scenario `number` from its first step, or the end of the study
+    state["scenario_count"] = number
+    if number > TOTAL_SCENARIOS:
+        state["study_completed"] = True
+        logging.info("Study completed")
+        return
+    apply_reset(state, RESETS["new_scenario"])
+    state["flow"] = SCENARIO_FLOWS[number]
+    state["step"] = first_step(number)
+    logging.info(f"Started scenario {number} in {state['flow']} flow at Step {state['step']}")
+
+
+def can_advance(state):
+    guard = GUARDS.get(state["step"])
+    return guard is None or bool(state[guard])
+
+
+def transition(state, event):
+    # event: "next" or "back". Returns True when the step (or scenario) changed.
+    if state.get("study_completed"):
+        return False
+    flow = FLOWS[state["flow"]]
+    index = flow.index(state["step"])
+    if event == "back":
+        if index == 0:
+            return False
+        apply_reset(state, RESETS["back"])
+        state["step"] = flow[index - 1]
+        logging.info(f"{state['flow'].capitalize()} flow: Moved back to Step {state['step']}")
+        return True
+    if event != "next":
+        raise ValueError(f"Unknown study flow event {event!r}")
+    if not can_advance(state):
+        return False
+    if index + 1 < len(flow):
+        apply_reset(state, RESETS["next"])
+        state["step"] = flow[index + 1]
+        logging.info(f"{state['flow'].capitalize()} flow: Moved to Step {state['step']}")
+        return True
+    logging.info(f"Completed scenario {state['scenario_count']} in {state['flow']} flow")
+    start_scenario(state, state["scenario_count"] + 1)
+    return True
+
+
+if __name__ == "__main__":
+    # Walk the whole study with every guard satisfied
+    state = {"scenario_count": 1, "flow": SCENARIO_FLOWS[1], "step": first_step(1)}
+    visited = []
+    while not state.get("study_completed"):
+        visited.append((state["scenario_count"], state["step"]))
+        for guard in GUARDS.values():
+            state[guard] = True
+        assert transition(state, "next")
+    for number in range(1, TOTAL_SCENARIOS + 1):
+        print(number, SCENARIO_FLOWS[number], [step for scenario, step in visited if scenario == number])